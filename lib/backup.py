@@ -0,0 +1,157 @@
+import os, sys, hashlib
+from ZODB.FileStorage import FileStorage
+from recorder import Recorder
+
+class Backup:
+    """ Incremental backup of the logs, notes, erratas databases.
+
+    A FileStorage only grows at the end, so each backup copies
+    the bytes appended since the previous one into a new chunk
+    file in the destination directory. The chunks of a database
+    are recorded in the state database of the destination as a
+    list of (file name, start offset, end offset, md5, tid).
+
+    When the source was packed or replaced, the recorded chunks
+    no longer match it, a new full copy is started then. The
+    chunk files are named by the generation of the copy and the
+    start offset, so the new copy never overwrites the old one,
+    which is removed once the new one is recorded.
+    """
+    state_file = '.backup_state'
+    block_size = 1 << 20
+
+    def __init__(self, config, dstdir):
+        self.paths  = [config.log_path, config.note_path, config.errata_path]
+        self.dstdir = dstdir
+
+    def open_state(self):
+        return Recorder(os.path.join(self.dstdir, self.state_file))
+
+    def backup(self):
+        """ Copy the new transactions of every database
+        """
+        if not os.path.isdir(self.dstdir):
+            print('%s not exists, or is not a directory' % self.dstdir, file=sys.stderr)
+            return
+        rec   = self.open_state()
+        state = rec.opendb()
+        for path in self.paths:
+            if not os.path.exists(path):
+                continue
+            name   = os.path.basename(path)
+            chunks = list(state.get(name, []))
+            end, tid = self.file_end(path)
+            stale    = []
+            gen      = self.generation(name, chunks)
+            if chunks and not self.verify_source(path, chunks[-1]):
+                print('%s changed since the last backup, full copy' % name)
+                stale, chunks = chunks, []
+                gen += 1
+            start = chunks[-1][2] if chunks else 0
+            if start == end:
+                print('%s: up to date' % name)
+                continue
+            chunk = self.copy(path, '%s.%04d' % (name, gen), start, end, tid)
+            chunks.append(chunk)
+            state[name] = chunks
+            rec.persist()
+            self.remove_chunks(stale)
+            print('%s: %s bytes copied to %s' % (name, end - start, chunk[0]))
+        rec.closedb()
+
+    def restore(self, outdir):
+        """ Rebuild full copies of the databases in outdir
+        from the chunks, checking the checksum of each chunk.
+        """
+        if not os.path.isdir(outdir):
+            print('%s not exists, or is not a directory' % outdir, file=sys.stderr)
+            return
+        rec   = self.open_state()
+        state = rec.opendb()
+        for name, chunks in state.items():
+            outpath = os.path.join(outdir, name)
+            with open(outpath, 'wb') as out:
+                offset = 0
+                for fname, start, end, md5, tid in chunks:
+                    if start != offset:
+                        raise ValueError('%s: gap before chunk %s' % (name, fname))
+                    digest = hashlib.md5()
+                    for data in self.read_range(os.path.join(self.dstdir, fname), 0, end - start):
+                        digest.update(data)
+                        out.write(data)
+                    if digest.hexdigest() != md5:
+                        raise ValueError('%s: checksum error in %s' % (name, fname))
+                    offset = end
+            # opening it makes sure the file is a sound FileStorage
+            FileStorage(outpath, read_only=True).close()
+            print('%s restored, %s bytes' % (outpath, offset))
+        rec.closedb()
+
+    def file_end(self, path):
+        """ return the size of the storage file, and the id of
+        the last committed transaction, which is within the size.
+        The storage is opened read only, no lock is needed. A
+        transaction being written may be copied in part, the next
+        chunk goes on with the rest, as the file is only appended.
+        """
+        fs = FileStorage(path, read_only=True)
+        try:
+            tid = fs.lastTransaction()
+        finally:
+            fs.close()
+        return os.path.getsize(path), tid
+
+    def read_range(self, path, start, end):
+        """ yield the data of the file between start and end
+        """
+        with open(path, 'rb') as file:
+            file.seek(start)
+            left = end - start
+            while left:
+                data = file.read(min(left, self.block_size))
+                if not data:
+                    raise ValueError('%s is shorter than expected' % path)
+                left -= len(data)
+                yield data
+
+    def verify_source(self, path, chunk):
+        """ check that the source still holds the data of the chunk
+        """
+        fname, start, end, md5, tid = chunk
+        if os.path.getsize(path) < end:
+            return False
+        digest = hashlib.md5()
+        for data in self.read_range(path, start, end):
+            digest.update(data)
+        return digest.hexdigest() == md5
+
+    def generation(self, name, chunks):
+        """ the generation of the copy the chunks belong to, the
+        chunk files of the first backups are named without one.
+        """
+        if not chunks:
+            return 0
+        parts = chunks[0][0][len(name)+1:].split('.')
+        return int(parts[0]) if len(parts) == 2 else 0
+
+    def copy(self, path, prefix, start, end, tid):
+        """ copy the range of the source to a new chunk file,
+        and return the chunk record, the checksum is of the data
+        as it is read.
+        """
+        fname   = '%s.%012d' % (prefix, start)
+        dstpath = os.path.join(self.dstdir, fname)
+        digest  = hashlib.md5()
+        with open(dstpath, 'wb') as out:
+            for data in self.read_range(path, start, end):
+                digest.update(data)
+                out.write(data)
+            out.flush()
+            os.fsync(out.fileno())
+        return (fname, start, end, digest.hexdigest(), tid)
+
+    def remove_chunks(self, chunks):
+        for chunk in chunks:
+            path = os.path.join(self.dstdir, chunk[0])
+            if os.path.exists(path):
+                os.unlink(path)
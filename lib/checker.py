@@ -0,0 +1,299 @@
+import os, sys, time
+from itertools import islice
+from logger import Logger
+from noter import Noter
+from errator import Errator
+from viewer import Viewer
+
+missing = object()
+
+def merge(items, others):
+    """ join two streams of (key, value) sorted by key, yield
+    (key, value, other), the value absent from a stream is
+    the 'missing' marker.
+    """
+    items  = iter(items)
+    others = iter(others)
+    item   = next(items, None)
+    other  = next(others, None)
+    while item is not None or other is not None:
+        if other is None or (item is not None and item[0] < other[0]):
+            yield item[0], item[1], missing
+            item = next(items, None)
+        elif item is None or other[0] < item[0]:
+            yield other[0], missing, other[1]
+            other = next(others, None)
+        else:
+            yield item[0], item[1], other[1]
+            item  = next(items, None)
+            other = next(others, None)
+
+class Checker:
+    """ Check the records and the derived containers of a store
+    in one streaming pass, the containers are walked in the key
+    order, the objects loaded are released from the cache as the
+    walk goes, so the memory stays bounded.
+
+    Each section of the check yields (key, problems) for the keys
+    with problems, a problem is (text, fix), fix is a function
+    which corrects it within a transaction, or None if it needs
+    a person to look at. The repair runs the fixes in batches of
+    'batch_size' keys, one transaction each, and resumes the walk
+    after the last key of the batch.
+    """
+    batch_size = 1000
+    gc_every   = 10000
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name     = name
+        self.count    = 0
+
+    def sections(self):
+        """ the check functions, each takes the key to start after
+        """
+        return []
+
+    def items(self, cont, start):
+        """ walk the container from after the start key
+        """
+        range = {} if start is None else dict(min=start, excludemin=True)
+        for item in cont.items(**range):
+            self.count += 1
+            if self.count % self.gc_every == 0:
+                self.recorder.conn.cacheGC()
+            yield item
+
+    def check(self, repair=False):
+        """ print the problems, return the number of those found
+        and the number of those fixed.
+        """
+        found = fixed = 0
+        for section in self.sections():
+            if not repair:
+                for key, problems in section(None):
+                    self.report(key, problems)
+                    found += len(problems)
+                continue
+            start = None
+            while True:
+                batch = list(islice(section(start), self.batch_size))
+                fixes = []
+                for key, problems in batch:
+                    self.report(key, problems, repair)
+                    found += len(problems)
+                    fixes += [fix for text, fix in problems if fix]
+                if fixes:
+                    def apply(cont):
+                        for fix in fixes:
+                            fix(cont)
+                    self.recorder.transact(apply)
+                    fixed += len(fixes)
+                if len(batch) < self.batch_size:
+                    break
+                start = batch[-1][0]
+        return found, fixed
+
+    def report(self, key, problems, repair=False):
+        for text, fix in problems:
+            note = ''
+            if repair:
+                note = ' (fixed)' if fix else ' (not fixed)'
+            print('%s: %s: %s%s' % (self.name, key, text, note))
+
+class LogChecker(Checker):
+    """ The logs are checked for:
+
+        key not the start time
+        complete log without end page, ending before
+        the start, or with the pages going backward
+        complete log overlapping the previous one
+        temporary log left while no book is being read
+
+    and the per day totals for the statistic of each key and
+    the sums of them. A bad complete log is repaired by making
+    it a temporary log again, to be completed by 'log', a log
+    under a wrong key is moved to its start time.
+    """
+    def __init__(self, logger, base_dir):
+        Checker.__init__(self, logger, os.path.basename(logger.db_path))
+        self.reading = bool(Viewer.active_sessions(base_dir))
+
+    def sections(self):
+        return [self.check_logs, self.check_days]
+
+    def counted_value(self, ent):
+        """ the counted value of the record, see Logger
+        """
+        if not ent.complete:
+            return missing
+        day = time.strftime('%Y-%m-%d', time.localtime(ent.start_time))
+        return (day, ent.end_page - ent.start_page, ent.duration(), ent.start_time,
+                ent.end_time, ent.start_page, ent.end_page)
+
+    def check_logs(self, start):
+        logger  = self.recorder
+        cont    = logger.opendb()
+        counted = logger.opendb(logger.countedName)
+        # a store whose statistic is not yet built is not wrong
+        built   = bool(counted) or not logger.opendb(logger.daysName)
+        if start is None:
+            self.last_end = None
+        others  = self.items(counted, start) if built else ()
+        for key, ent, count in merge(self.items(cont, start), others):
+            problems = []
+            if ent is missing:
+                problems.append(('statistic of a missing log',
+                                 lambda cont, key=key: logger.count_remove(key)))
+                yield key, problems
+                continue
+            bad = None
+            if ent.complete:
+                if ent.end_page is None:
+                    bad = 'complete log without end page'
+                elif ent.end_time < ent.start_time:
+                    bad = 'log ends before it starts'
+                elif ent.end_page < ent.start_page:
+                    bad = 'log pages go backward'
+                elif self.last_end is not None and ent.start_time < self.last_end:
+                    problems.append(('log overlaps the previous one', None))
+            elif not self.reading:
+                problems.append(('temporary log left, complete it by "log" or remove it by "cl"', None))
+            if bad:
+                problems.append((bad, lambda cont, key=key: self.uncomplete(cont, key)))
+            elif built and count != self.counted_value(ent):
+                problems.append(('statistic out of date',
+                                 lambda cont, key=key: logger.put(cont, key, cont[key])))
+            if ent.complete and not bad:
+                self.last_end = max(self.last_end or 0, ent.end_time)
+            if key != str(ent.start_time):
+                problems.append(('key does not match the start time %s' % ent.start_time,
+                                 lambda cont, key=key: self.move(cont, key)))
+            if problems:
+                yield key, problems
+
+    def uncomplete(self, cont, key):
+        ent = cont[key]
+        ent.complete = False
+        self.recorder.put(cont, key, ent)
+
+    def move(self, cont, key):
+        """ store the log under its start time, unless that key
+        is taken, the fixes of one key run in order, this is
+        the last one.
+        """
+        ent = cont[key]
+        new = str(ent.start_time)
+        if new in cont:
+            print('%s: %s: key %s taken, not moved' % (self.name, key, new), file=sys.stderr)
+            return
+        self.recorder.drop(cont, key)
+        self.recorder.put(cont, new, ent)
+
+    def check_days(self, start):
+        """ the day totals against the sums of the statistic,
+        the sums are kept per day, not per record.
+        """
+        logger  = self.recorder
+        days    = logger.opendb(logger.daysName)
+        counted = logger.opendb(logger.countedName)
+        if start is None:
+            # the repair of the days does not change the sums
+            self.sums = {}
+            for key, (day, pages, seconds, *times) in self.items(counted, None):
+                total = self.sums.get(day, (0, 0))
+                self.sums[day] = (total[0] + pages, total[1] + seconds)
+        sums = sorted(x for x in self.sums.items() if start is None or x[0] > start)
+        for day, total, expect in merge(self.items(days, start), sums):
+            if total == expect:
+                continue
+            if expect is missing:
+                text = 'day total without logs'
+                fix  = lambda cont, day=day: logger.opendb(logger.daysName).pop(day)
+            else:
+                text = 'day total %s, logs sum up to %s' % (
+                        None if total is missing else total, expect)
+                fix  = lambda cont, day=day, expect=expect: \
+                            logger.opendb(logger.daysName).__setitem__(day, expect)
+            yield day, [(text, fix)]
+
+class NoteChecker(Checker):
+    """ The notes and errata are checked for keys that are not
+    times and missing fields, and the index, indexed and stamps
+    containers against the records. The derived containers are
+    repaired, the records are only reported.
+    """
+    def __init__(self, noter):
+        Checker.__init__(self, noter, os.path.basename(noter.db_path))
+        self.fields = [name for name, kind in noter.batch_fields] + ['content']
+
+    def sections(self):
+        return [self.check_records, self.check_index]
+
+    def check_records(self, start):
+        noter   = self.recorder
+        cont    = noter.opendb()
+        indexed = noter.opendb(noter.indexedName)
+        for key, ent, value in merge(self.items(cont, start), self.items(indexed, start)):
+            problems = []
+            if ent is missing:
+                problems.append(('indexed value of a missing record',
+                                 lambda cont, key=key: noter.index_remove(key)))
+                yield key, problems
+                continue
+            if not key.isdigit():
+                problems.append(('key is not a time', None))
+            absent = [x for x in self.fields if not hasattr(ent, x)]
+            if absent:
+                problems.append(('missing %s' % ', '.join(absent), None))
+            else:
+                expect = noter.index_key(ent)
+                keys   = noter.opendb(noter.indexName).get(expect, ())
+                if value != expect or key not in keys:
+                    problems.append(('not indexed under %s' % expect,
+                                     lambda cont, key=key: noter.put(cont, key, cont[key])))
+            if problems:
+                yield key, problems
+
+    def check_index(self, start):
+        noter   = self.recorder
+        index   = noter.opendb(noter.indexName)
+        indexed = noter.opendb(noter.indexedName)
+        stamps  = noter.opendb(noter.stampsName)
+        for value, keys in self.items(index, start):
+            problems = []
+            stray = [key for key in keys if indexed.get(key, missing) != value]
+            if stray:
+                problems.append(('index has %s stray keys' % len(stray),
+                                 lambda cont, value=value, stray=stray:
+                                    self.unindex(value, stray)))
+            if noter.group_key(value) not in stamps:
+                problems.append(('group not stamped',
+                                 lambda cont, value=value: noter.touch(value)))
+            if problems:
+                yield value, problems
+
+    def unindex(self, value, stray):
+        noter = self.recorder
+        index = noter.opendb(noter.indexName)
+        keys  = index[value]
+        for key in stray:
+            keys.remove(key)
+        if not keys:
+            del index[value]
+
+def fsck(config, repair=False):
+    """ Check all stores, return the number of problems left
+    """
+    checkers = [LogChecker(Logger(config.log_path), config.base_dir),
+                NoteChecker(Noter(config.note_path, config.book_name)),
+                NoteChecker(Errator(config.errata_path, config.book_name))]
+    left = 0
+    for checker in checkers:
+        begin = time.time()
+        found, fixed = checker.check(repair)
+        checker.recorder.closedb()
+        left += found - fixed
+        print('%s: %s entries checked, %s problems, %s fixed, %.1fs' % (
+                checker.name, checker.count, found, fixed, time.time() - begin))
+    return left
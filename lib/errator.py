@@ -1,10 +1,43 @@
 from noter import Noter
 import interact
+import re
+
+def page_number(page):
+    """ normalize the free-text page of an errata to a
+    number, the first number in the text, None if none.
+    """
+    match = re.search(r'\d+', str(page))
+    return int(match.group()) if match else None
 
 class Errator(Noter):
+    """ Errata are indexed by the page number, the ones without
+    a number in the page under -1, and grouped by hundred pages.
+    """
+    indexName = 'by_page'
+    groupSize = 100
+    batch_fields = [('page', str)]
+
     def make_makers(self):
         makers = []
         makers.append(('book',    (lambda x: self.book_name, None)))
         makers.append(('page',    (interact.readstr, 'Page: ')))
         makers.append(('content', (self.edit_content, None)))
         self.makers = makers
+
+    def index_key(self, ent):
+        number = page_number(ent.page)
+        return -1 if number is None else number
+
+    def group_key(self, value):
+        return value // self.groupSize
+
+    def group_range(self, group):
+        if group < 0:
+            return -1, -1
+        return group * self.groupSize, (group + 1) * self.groupSize - 1
+
+    def show(self, errata):
+        print('-' * 80)
+        print('Book: %s' % errata.book)
+        print('Page: %s' % errata.page)
+        print('Content:\n%s' % errata.content)
@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+"""
+Test of the session supervisor with a fake viewer: start many
+reading sessions at the same time in a new base directory, then
+one more which is stopped before the viewer records its page.
+Check that the sessions are logged complete, and the stopped one
+as a temporary log, not with the page left by the others.
+
+The fake viewer waits some seconds, then records the page it was
+opened at plus 5 in the viewer log the way the viewer does, it
+records nothing when it is terminated.
+
+Usage: fakeview.py [sessions] [seconds]
+       fakeview.py view page book viewer_log seconds
+"""
+
+import sys, os, time, shlex, signal, tempfile
+import supervisor
+from recorder import Recorder
+from logger import Logger
+from viewer import Viewer
+from reader import Config
+
+def view(page, book, viewer_log, seconds):
+    signal.signal(signal.SIGTERM, lambda *args: os._exit(1))
+    time.sleep(float(seconds))
+    with open(viewer_log, 'w') as f:
+        # the viewer counts the pages from 0
+        f.write('%s %s\n' % (os.path.realpath(book), int(page) - 1 + 5))
+
+def command(viewer_log, seconds):
+    return ' '.join(shlex.quote(x) for x in
+            [sys.executable, os.path.realpath(__file__), 'view',
+             '{page}', '{book}', viewer_log, str(seconds)])
+
+def wait_logs(config, count, timeout=30):
+    """ return the logs once there are count of them
+    """
+    logger = Logger(config.log_path)
+    start  = time.time()
+    while True:
+        if os.path.exists(config.log_path):
+            logs = list(logger.opendb().values())
+            logger.closedb()
+            if len(logs) >= count or time.time() - start > timeout:
+                return logs
+        time.sleep(0.5)
+
+def fakeview(sessions=8, seconds=1):
+    """ return True if the sessions are logged as expected
+    """
+    base = tempfile.mkdtemp()
+    Viewer.viewer_log = os.path.join(base, '.pv')    # the supervisor forks from here
+    open(os.path.join(base, 'book.pdf'), 'w').close()
+    rec = Recorder(os.path.join(base, Config.config_file))
+    db  = rec.opendb()
+    db.update(dict(book_name='fake', book_file='book.pdf', end_page=500,
+                   log_file='.log', note_file='.note', errata_file='.errata',
+                   page_num_diff=10, page_per_day=18, init_done=True,
+                   viewer_command=command(Viewer.viewer_log, seconds)))
+    rec.persist()
+    rec.closedb()
+    config = Config(base)
+
+    start = time.time()
+    for i in range(sessions):
+        supervisor.request(config, {'op': 'read', 'page': 20 + i, 'log': True}, start=True)
+    logs = wait_logs(config, sessions)
+    elapsed = time.time() - start
+    # one viewer log for the book, the page of the last viewer to quit
+    complete = [x for x in logs if x.complete and x.end_page]
+    print('%s sessions: %s logged, %s complete, %.2fs' % (
+            sessions, len(logs), len(complete), elapsed))
+
+    # the settings are read again by the supervisor for a session
+    config.set(viewer_command=command(Viewer.viewer_log, 60))
+    reply = supervisor.request(config, {'op': 'read', 'page': 100, 'log': True})
+    time.sleep(seconds)
+    supervisor.request(config, {'op': 'stop', 'id': reply['session']['id']})
+    stopped = [x for x in wait_logs(config, sessions + 1) if x.start_page == 100]
+    temporary = stopped and not stopped[0].complete and stopped[0].end_page is None
+    print('stopped session: %s' % ('temporary log' if temporary else stopped or 'not logged'))
+    return len(logs) == len(complete) == sessions and temporary
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['view']:
+        view(*sys.argv[2:])
+    else:
+        args = [int(x) for x in sys.argv[1:3]]
+        exit(0 if fakeview(*args) else 1)
@@ -1,7 +1,13 @@
 from record import Record
 from recorder import Recorder
-from timeutils import isotime, strtosecond
+from timeutils import isotime, strtosecond, DayClock
+from schema import Migrator
+from itertools import islice
+from BTrees.OOBTree import OOBTree
 import time
+import copy
+import sys
+import os
 import interact
 
 class LogEntry(Record):
@@ -11,7 +17,7 @@ class LogEntry(Record):
     def __str__(self):
         start   = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.start_time))
         end     = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.end_time))
-        seconds = self.end_time - self.start_time
+        seconds = self.duration()
         dura_h  = seconds // 3600
         dura_m  = (seconds % 3600) // 60
         dura_s  = seconds % 60
@@ -19,16 +25,53 @@ class LogEntry(Record):
                     start, dura_h, dura_m, dura_s, self.start_page, self.end_page, end)
         return text
 
-    def detail(self):
-        start_time  = time.strftime('%Y-%m-%d %H:%M', time.localtime(self.start_time))
-        end_time    = time.strftime('%Y-%m-%d %H:%M', time.localtime(self.end_time))
-        duration    = (self.end_time - self.start_time) // 60
+    def duration(self):
+        """ the seconds of reading, the pauses excluded
+        """
+        return self.end_time - self.start_time - self.paused
+
+    def detail(self, clock=None):
+        """ a DayClock can be given for formatting many entries
+        """
+        if clock:
+            start_time  = clock(self.start_time)
+            end_time    = clock(self.end_time)
+        else:
+            start_time  = time.strftime('%Y-%m-%d %H:%M', time.localtime(self.start_time))
+            end_time    = time.strftime('%Y-%m-%d %H:%M', time.localtime(self.end_time))
+        duration    = self.duration() // 60
         page_count  = self.end_page - self.start_page
         format      = '[%s] - [%s] (%3d mins): %s-%s (%2d pages)'
         return format % (start_time, end_time, duration,
                         self.start_page, self.end_page, page_count)
 
 
+class CountedTree(OOBTree):
+    """ the tree of the counted values, they are small and read
+    in bulk by the listing, so the buckets are made larger, fewer
+    objects are loaded.
+    """
+    max_leaf_size     = 500
+    max_internal_size = 1000
+
+
+def last_complete(cont, before=None):
+    """ the key of the latest complete log in the container
+    started before the second 'before', looked up backwards from
+    the end of the key range, only the temporary logs on the way
+    are read.
+    """
+    key = None if before is None else str(before - 1)
+    while True:
+        try:
+            key = cont.maxKey() if key is None else cont.maxKey(key)
+        except ValueError:
+            return None
+        if cont[key].complete:
+            return key
+        key = str(int(key) - 1)
+
+
 class Logger(Recorder):
     """ Logging both the temporory log and the complete log
 
@@ -37,10 +80,129 @@ class Logger(Recorder):
         start_time
         end_time
         start_page
-        end_page.
+        end_page
+        paused, seconds of pause within the log.
 
     key of the log entry is the current time stamp.
+
+    The pages and seconds of the complete logs are summed up
+    per day in the 'days' container as they are saved, the
+    'counted' container records what each key contributed.
+    They are the running statistic used by the adaptive plan.
+    The changes of the day totals are gathered while the logs
+    are written, and applied to the days once at the commit.
+
+    A counted value also holds the times and pages of the log,
+    (day, pages, seconds, start_time, end_time, start_page,
+    end_page), so the listing reads these small tuples instead
+    of loading every log entry.
     """
+    daysName     = 'days'
+    countedName  = 'counted'
+    undoName     = 'compacted'
+    undoKey      = 'compacted.last'  # the id of the last compaction
+    undoKeep     = 5                 # the compactions which can be undone
+    builtKey     = 'days.built'
+    builtVersion = 2            # the format of the counted values
+    journaled    = True
+
+    def __init__(self, db_path, contName=None, page_map=None):
+        Recorder.__init__(self, db_path, contName)
+        self.page_map = page_map    # pages asked and shown by label when given
+        self.clock    = DayClock()
+        self.changed  = {}          # day -> [pages, seconds] to add at commit
+
+    def opendb(self, contName=None):
+        """ make sure the statistic containers exist before any
+        writing, creating them commits the transaction. The
+        statistic of a database saved before it was kept, or
+        kept in an older format, is built the first time the
+        database is opened.
+        """
+        if contName is None:
+            Recorder.opendb(self, self.daysName)
+            Recorder.opendb(self, self.countedName)
+            cont  = Recorder.opendb(self, contName)
+            state = Recorder.opendb(self, Migrator.schemaName)
+            if state.get(self.builtKey) != self.builtVersion:
+                self.build_totals()
+            return cont
+        return Recorder.opendb(self, contName)
+
+    def build_totals(self):
+        """ count all logs, in one transaction
+        """
+        def build(cont):
+            self.opendb(self.daysName).clear()
+            # a new tree, the one of an older version may be of another kind
+            counted = self.containers[self.countedName] = self.newContainer(self.countedName)
+            setattr(self.conn.root, self.countedName, counted)
+            for key, ent in cont.items():
+                self.count_add(key, ent)
+            self.opendb(Migrator.schemaName)[self.builtKey] = self.builtVersion
+        self.transact(build, self.contName)
+
+    def newContainer(self, contName):
+        if contName == self.countedName:
+            return CountedTree()
+        return Recorder.newContainer(self, contName)
+
+    def count_add(self, key, ent):
+        if not ent.complete:
+            return
+        day     = self.clock.day(ent.start_time)
+        pages   = ent.end_page - ent.start_page
+        seconds = ent.duration()
+        self.change_day(day, pages, seconds)
+        self.opendb(self.countedName)[key] = (day, pages, seconds, ent.start_time,
+                                              ent.end_time, ent.start_page, ent.end_page)
+
+    def count_remove(self, key):
+        counted = self.opendb(self.countedName)
+        if key not in counted:
+            return
+        day, pages, seconds = counted.pop(key)[:3]
+        self.change_day(day, -pages, -seconds)
+
+    def change_day(self, day, pages, seconds):
+        """ the day totals are changed once per transaction
+        """
+        change = self.changed.setdefault(day, [0, 0])
+        change[0] += pages
+        change[1] += seconds
+
+    def persist(self):
+        days = self.opendb(self.daysName)
+        for day, (pages, seconds) in self.changed.items():
+            if (pages, seconds) == (0, 0):
+                continue
+            total = days.get(day, (0, 0))
+            total = (total[0] + pages, total[1] + seconds)
+            if total == (0, 0):
+                del days[day]
+            else:
+                days[day] = total
+        self.changed = {}
+        Recorder.persist(self)
+
+    def abort(self):
+        self.changed = {}
+        Recorder.abort(self)
+
+    def put(self, cont, key, ent):
+        self.count_remove(key)
+        Recorder.put(self, cont, key, ent)
+        self.count_add(key, ent)
+
+    def drop(self, cont, key):
+        self.count_remove(key)
+        Recorder.drop(self, cont, key)
+
+    def day_totals(self):
+        """ return the container of the (pages, seconds) of each day
+        """
+        self.opendb()
+        return self.opendb(self.daysName)
 
     def make_log(self, book_name, start_time, end_time,
                     start_page, end_page=None, complete=False):
@@ -56,6 +218,7 @@ class Logger(Recorder):
         ent.start_page  = start_page
         ent.end_page    = end_page
         ent.complete    = complete
+        ent.paused      = 0
         return ent
 
     def fetch_tmplogs(self):
@@ -102,8 +265,11 @@ class Logger(Recorder):
         return self.ask_page(prompt, default)
 
     def ask_page(self, prompt='', default=None):
-        """ interactively ask the user for page number
+        """ interactively ask the user for page number, or for
+        the page label if the logger has the page map.
         """
+        if self.page_map:
+            return self.ask_label(prompt, default)
         if default:
             extra_text = '[%s]' % default
             prompt = '%s %s: ' % (prompt, extra_text)
@@ -117,32 +283,91 @@ class Logger(Recorder):
             print('bad value, exit')
             exit(1)
 
+    def ask_label(self, prompt, default=None):
+        page_map = self.page_map
+        if default is not None:
+            default = page_map.label_of(default)
+            prompt  = '%s [%s]: ' % (prompt, default)
+        else:
+            prompt  = '%s: ' % prompt
+        while True:
+            try:
+                return page_map.number_of(interact.readstr(prompt, default))
+            except ValueError as e:
+                print(e, file=sys.stderr)
+
     def last_complete_log(self):
         """ return the latest log that is completed
         """
         cont = self.opendb()
-        logs = (x for x in cont.values() if x.complete)
-        logs = sorted(logs, key=lambda x: int(x.start_time))
-        return logs[-1] if logs else None
+        key  = last_complete(cont)
+        return cont[key] if key else None
 
     def fetch_complete(self):
-        cont = self.opendb()
-        logs = [x for x in cont.values() if x.complete]
-        logs = sorted(logs, key=lambda x: int(x.start_time))
-        return logs
+        return list(self.iter_complete())
+
+    def iter_complete(self, since=None, until=None):
+        """ yield the complete logs started between since and until
+        (seconds, both inclusive) in time order, straight from the
+        key order of the container, the keys are the start times.
+        """
+        cont  = self.opendb()
+        range = {}
+        if since is not None:
+            range['min'] = str(since)
+        if until is not None:
+            range['max'] = str(until)
+        for key, log in cont.items(**range):
+            if log.complete:
+                yield log
 
-    def list(self):
-        """ list all complete log entries
+    def list(self, since=None, until=None, limit=None):
+        """ list the complete log entries from the counted values,
+        the lines of LogEntry.detail with the page labels, the output
+        is written in chunks rather than line by line.
         """
-        for log in self.fetch_complete():
-            print(log.detail())
+        self.opendb()
+        counted = self.opendb(self.countedName)
+        range   = {}
+        if since is not None:
+            range['min'] = str(since)
+        if until is not None:
+            range['max'] = str(until)
+        clock   = DayClock()
+        format  = '[%s] - [%s] (%3d mins): %s-%s (%2d pages)'
+        chunk   = []
+        # the pages are shown by label, a book with a single decimal
+        # range has the numbers as labels
+        label   = None
+        if self.page_map and len(self.page_map.starts) > 1:
+            label = self.page_map.label_of
+        try:
+            for day, pages, seconds, start, end, spage, epage in islice(
+                                        counted.values(**range), limit):
+                if label:
+                    spage, epage = label(spage), label(epage)
+                chunk.append(format % (clock(start), clock(end), seconds // 60,
+                                       spage, epage, pages))
+                if len(chunk) >= 1000:
+                    sys.stdout.write('\n'.join(chunk) + '\n')
+                    chunk = []
+            if chunk:
+                sys.stdout.write('\n'.join(chunk) + '\n')
+            sys.stdout.flush()
+        except BrokenPipeError:
+            # the reader of the pipe quit, e.g. head, what is left
+            # in the buffer goes to devnull when python flushes it
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            exit(1)
 
     def list_sum(self):
+        """ the minutes and pages of each day, from the counted
+        values of the complete logs
+        """
+        self.opendb()
         result = {}
-        for log in self.fetch_complete():
-            day         = time.strftime('%Y-%m-%d', time.localtime(log.start_time))
-            duration    = (log.end_time - log.start_time) // 60
-            pages       = log.end_page - log.start_page
+        for day, pages, seconds in (x[:3] for x in self.opendb(self.countedName).values()):
+            duration    = seconds // 60
             if day in result:
                 result[day][0] += duration      # time summary
                 result[day][1] += pages         # page summary
@@ -156,24 +381,138 @@ class Logger(Recorder):
     def clear_tmp_log(self):
         """ clear the temporary log
         """
-        cont = self.opendb()
-        for k, v in cont.items():
-            if not v.complete:
-                del cont[k]
-        self.persist()
+        def clear(cont):
+            for k in [k for k, v in cont.items() if not v.complete]:
+                self.drop(cont, k)
+        self.transact(clear)
+
+    def runs(self, cont, gap):
+        """ yield the keys of each run of complete logs which
+        can be merged: on the same day, each starting at the page
+        the previous ended, less than gap seconds after it.
+        """
+        run  = []
+        last = None
+        for key, ent in cont.items():
+            if (ent.complete and last is not None and
+                    0 <= ent.start_time - last.end_time < gap and
+                    ent.start_page == last.end_page and
+                    time.localtime(ent.start_time)[:3] == time.localtime(last.start_time)[:3]):
+                run.append(key)
+            else:
+                if len(run) > 1:
+                    yield run
+                run = [key] if ent.complete else []
+            last = ent if ent.complete else None
+        if len(run) > 1:
+            yield run
+
+    def compact(self, gap):
+        """ Merge the runs of logs into one log each, the time
+        between them is recorded as pause, so the per day totals
+        do not change. The original logs are kept in the undo
+        container under (compaction id, key), with the merged log,
+        or None for the ones removed, to tell a later change. The
+        ids go up by one for each compaction, only the last
+        'undoKeep' of them are kept. All is done in one transaction,
+        return the number of logs removed.
+        """
+        self.opendb(self.undoName)
+
+        def merge(cont):
+            undo    = self.opendb(self.undoName)
+            state   = self.opendb(Migrator.schemaName)
+            self.upgrade_undo(cont, undo)
+            runs    = list(self.runs(cont, gap))
+            if not runs:
+                return 0
+            id      = state.get(self.undoKey, 0) + 1
+            removed = 0
+            for run in runs:
+                logs  = [cont[key] for key in run]
+                for key, ent in zip(run, logs):
+                    undo[(id, key)] = (copy.copy(ent), None)
+                first = logs[0]
+                gaps  = sum(b.start_time - a.end_time for a, b in zip(logs, logs[1:]))
+                first.paused   = sum(x.paused for x in logs) + gaps
+                first.end_time = logs[-1].end_time
+                first.end_page = logs[-1].end_page
+                for key in run[1:]:
+                    self.drop(cont, key)
+                self.put(cont, run[0], first)
+                undo[(id, run[0])] = (undo[(id, run[0])][0], copy.copy(first))
+                removed += len(run) - 1
+            state[self.undoKey] = id
+            for key in list(undo.keys(max=(id - self.undoKeep + 1,), excludemax=True)):
+                del undo[key]
+            return removed
+        return self.transact(merge)
+
+    def upgrade_undo(self, cont, undo):
+        """ the undo logs kept before the compaction ids were keyed
+        by the time stamp and held the original logs only, number
+        them in time order, and take the logs as they are now, or
+        as the next compaction found them, for the merged ones.
+        """
+        if not undo or not isinstance(undo.minKey()[0], str):
+            return
+        stamps = sorted({stamp for stamp, key in undo.keys()})
+        items  = list(undo.items())
+        later  = {key: copy.copy(cont[key]) for stamp, key in undo.keys() if key in cont}
+        undo.clear()
+        for id, stamp in reversed(list(enumerate(stamps, 1))):
+            group = [(key, ent) for (x, key), ent in items if x == stamp]
+            for key, ent in group:
+                undo[(id, key)] = (ent, later.get(key))
+            for key, ent in group:
+                later[key] = ent
+        state = self.opendb(Migrator.schemaName)
+        state[self.undoKey] = max(state.get(self.undoKey, 0), len(stamps))
+
+    def uncompact(self, force=False):
+        """ Restore the logs merged by the last compaction, return
+        the number of logs restored, None if none left. ValueError
+        is raised if any of them changed after the compaction,
+        unless force is True.
+        """
+        def same(a, b):
+            if a is None or b is None:
+                return a is b
+            return a.__getstate__() == b.__getstate__()
+
+        def restore(cont):
+            undo = self.opendb(self.undoName)
+            self.upgrade_undo(cont, undo)
+            if not undo:
+                return None
+            id    = undo.maxKey()[0]
+            items = list(undo.items(min=(id,)))
+            changed = [key for (junk, key), (ent, merged) in items
+                            if not same(cont.get(key), merged)]
+            if changed and not force:
+                raise ValueError('changed since the compaction: %s' % ', '.join(changed))
+            for (junk, key), ent in items:
+                if key in cont:
+                    self.drop(cont, key)
+            for (junk, key), (ent, merged) in items:
+                self.put(cont, key, ent)
+                del undo[(junk, key)]
+            return len(items)
+        self.opendb(self.undoName)
+        return self.transact(restore)
 
     def dellast(self):
         cont = self.opendb()
-        keys = [k for k in cont if cont[k].complete]
-        if not keys: return
-        key = sorted(keys)[-1]
-        log = cont[key]
+        key  = last_complete(cont)
+        if not key: return
+        log  = cont[key]
+        # do not hold the database while waiting for the user
+        self.closedb()
         default = 'n'
         i = interact.readstr('%s\nconfirm? [%s] ' % (log.detail(), default), default)
         if i not in ('y', 'Y'):
             return
-        del cont[key]
-        self.persist()
+        self.delete(key)
 
     def cal_start_page(self):
         """ calculate the starting page of
@@ -1,15 +1,155 @@
 from record import Record
 from recorder import Recorder
+from BTrees.OOBTree import OOTreeSet
 from timeutils import isotime
+from schema import Migrator
 import time
 import interact
 import os
+import re
 
 class Noter(Recorder):
+    """ Notes are kept in the main container keyed by the
+    creation time, the index container maps the chapter to
+    the keys of the notes in it, and the indexed container
+    records the indexed value of each key. The stamps container
+    records when the notes of each group last changed, a group
+    is what gets published as one file.
+
+    The indexes of a store saved before they were kept, or in an
+    older form, are built the first time the store is opened.
+    """
+    indexName    = 'by_chapter'
+    indexedName  = 'indexed'
+    stampsName   = 'stamps'
+    indexKey     = 'index.built'
+    indexVersion = 1            # the errata without a page number under -1
+    journaled    = True
+
     def __init__(self, db_path, book_name):
         Recorder.__init__(self, db_path)
         self.book_name = book_name
 
+    def opendb(self, contName=None):
+        """ make sure the index containers exist before any
+        writing, creating them commits the transaction.
+        """
+        if contName is None:
+            Recorder.opendb(self, self.indexName)
+            Recorder.opendb(self, self.indexedName)
+            Recorder.opendb(self, self.stampsName)
+            cont  = Recorder.opendb(self, contName)
+            state = Recorder.opendb(self, Migrator.schemaName)
+            if state.get(self.indexKey) != self.indexVersion:
+                self.build_index()
+            return cont
+        return Recorder.opendb(self, contName)
+
+    def index_key(self, ent):
+        """ the value of the record to be indexed, None for no index
+        """
+        return ent.chapter
+
+    def group_key(self, value):
+        """ the group of an indexed value
+        """
+        return value
+
+    def group_range(self, group):
+        """ the (low, high) indexed values of a group
+        """
+        return group, group
+
+    def touch(self, value):
+        """ mark the group of the value as changed
+        """
+        self.opendb(self.stampsName)[self.group_key(value)] = time.time()
+
+    def index_add(self, key, ent):
+        value = self.index_key(ent)
+        if value is None:
+            return
+        self.touch(value)
+        index = self.opendb(self.indexName)
+        keys  = index.get(value)
+        if keys is None:
+            keys = index[value] = OOTreeSet()
+        keys.add(key)
+        self.opendb(self.indexedName)[key] = value
+
+    def index_remove(self, key):
+        """ remove the key from the index, the indexed value is
+        taken from the indexed container rather than the record,
+        since the record itself may have been changed in place.
+        """
+        indexed = self.opendb(self.indexedName)
+        if key not in indexed:
+            return
+        value = indexed.pop(key)
+        self.touch(value)
+        index = self.opendb(self.indexName)
+        keys  = index.get(value)
+        if keys is None or key not in keys:
+            return
+        keys.remove(key)
+        if not keys:
+            del index[value]
+
+    def put(self, cont, key, ent):
+        """ store the record, and update the index in the same transaction
+        """
+        self.index_remove(key)
+        Recorder.put(self, cont, key, ent)
+        self.index_add(key, ent)
+
+    def drop(self, cont, key):
+        """ delete the record and its index entry
+        """
+        self.index_remove(key)
+        Recorder.drop(self, cont, key)
+
+    def remove(self, key):
+        Recorder.delete(self, key)
+
+    def build_index(self):
+        """ rebuild the index from all the records, in one
+        transaction, return the number of records.
+        """
+        def rebuild(cont):
+            self.opendb(self.indexName).clear()
+            self.opendb(self.indexedName).clear()
+            for key, ent in cont.items():
+                self.index_add(key, ent)
+            self.opendb(Migrator.schemaName)[self.indexKey] = self.indexVersion
+            return len(cont)
+        return self.transact(rebuild, self.contName)
+
+    def reindex(self):
+        count = self.build_index()
+        print('done, %s records indexed' % count)
+
+    def lookup(self, low, high=None):
+        """ yield (key, record) of the records whose indexed
+        value is between low and high, in the index order.
+        """
+        if high is None:
+            high = low
+        cont  = self.opendb()
+        index = self.opendb(self.indexName)
+        for value, keys in index.items(min=low, max=high):
+            for key in keys:
+                yield key, cont[key]
+
+    def query(self, low, high=None):
+        """ print the records whose indexed value is in the range
+        """
+        count = 0
+        for key, ent in self.lookup(low, high):
+            self.show(ent)
+            count += 1
+        if not count:
+            print('nothing found')
+
     def make_makers(self):
         makers = []
         makers.append(('book',    (lambda x: self.book_name, None)))
@@ -27,6 +167,8 @@ class Noter(Recorder):
         for time, note in notes:
             text = isotime(int(time)) + '\n' + note.content[:80]
             text_list.append(text)
+        # do not hold the database while waiting for the user
+        self.closedb()
         idx, junk = interact.printAndPick(text_list)
 
         key  = notes[idx][0]
@@ -51,8 +193,10 @@ class Noter(Recorder):
             idx = res[0]
         else:
             return
-        key  = notes[idx][0]
         note = notes[idx][1]
+        self.show(note)
+
+    def show(self, note):
         print('-' * 80)
         print('Book: %s' % note.book)
         print('Chapter: %s' % note.chapter)
@@ -60,7 +204,160 @@ class Noter(Recorder):
         print('Content:\n%s' % note.content)
 
     def delete(self):
-        assert False, 'not yet implemented'
+        """ delete a picked note
+        """
+        cont = self.opendb()
+        notes = sorted(cont.items(), key=lambda x: int(x[0]))
+        text_list = []
+        for time, note in notes:
+            text = isotime(int(time)) + '\n' + note.content[:80]
+            text_list.append(text)
+        # do not hold the database while waiting for the user
+        self.closedb()
+        idx, junk = interact.printAndPick(text_list)
+        if idx is None:
+            return
+        default = 'n'
+        i = interact.readstr('confirm? [%s] ' % default, default)
+        if i not in ('y', 'Y'):
+            return
+        self.remove(notes[idx][0])
+
+    # fields edited in the batch document, besides the content
+    batch_fields = [('chapter', int), ('subject', str)]
+    batch_help = """\
+# Each record starts with a line '=== <key>', then the fields,
+# then a line '---', and the content up to the next record.
+# Change the fields or the content to edit a record, remove
+# the whole record to delete it, and add a record starting
+# with '=== new' to add one. Lines starting with '#' before
+# the first record are ignored. A content line starting with
+# '=== ' is written with a '\\' before it, which is dropped.
+"""
+    # content lines that would read as a record start, escaped or not
+    batch_escaped = re.compile(r'\\*=== ')
+
+    def batch_text(self, records):
+        """ the document of the records for batch editing
+        """
+        parts = [self.batch_help]
+        for key, ent in records:
+            parts.append('=== %s\n' % key)
+            for name, conv in self.batch_fields:
+                parts.append('%s: %s\n' % (name.capitalize(), getattr(ent, name)))
+            parts.append('---\n')
+            content = ent.content
+            content = content if content.endswith('\n') else content + '\n'
+            parts.extend('\\' + x if self.batch_escaped.match(x) else x
+                            for x in content.splitlines(keepends=True))
+        return ''.join(parts)
+
+    def batch_parse(self, text):
+        """ parse the edited document into a list of (key, fields),
+        key is None for the new records. ValueError if malformed.
+        """
+        result = []
+        lines  = text.splitlines(keepends=True)
+        i = 0
+        while i < len(lines) and not lines[i].startswith('=== '):
+            if lines[i].strip() and not lines[i].startswith('#'):
+                raise ValueError('line %s: a record must start with "=== "' % (i + 1))
+            i += 1
+        while i < len(lines):
+            key = lines[i][4:].strip()
+            if key != 'new' and not key.isdigit():
+                raise ValueError('line %s: bad key %r' % (i + 1, key))
+            fields = {}
+            i += 1
+            for name, conv in self.batch_fields:
+                if i >= len(lines) or ':' not in lines[i]:
+                    raise ValueError('line %s: %s expected' % (i + 1, name.capitalize()))
+                label, value = lines[i].split(':', 1)
+                if label.strip().lower() != name:
+                    raise ValueError('line %s: %s expected' % (i + 1, name.capitalize()))
+                try:
+                    fields[name] = conv(value.strip())
+                except ValueError:
+                    raise ValueError('line %s: bad %s' % (i + 1, name))
+                i += 1
+            if i >= len(lines) or lines[i].strip() != '---':
+                raise ValueError('line %s: "---" expected' % (i + 1))
+            i += 1
+            content = []
+            while i < len(lines) and not lines[i].startswith('=== '):
+                line = lines[i]
+                if line.startswith('\\') and self.batch_escaped.match(line[1:]):
+                    line = line[1:]
+                content.append(line)
+                i += 1
+            fields['content'] = ''.join(content)
+            result.append((None if key == 'new' else key, fields))
+        return result
+
+    def batch(self, low=None, high=None):
+        """ edit the records whose indexed value is between low
+        and high, or all of them, in one editor session, and apply
+        the additions, changes and deletions in one transaction.
+        """
+        if low is None:
+            records = sorted(self.opendb().items(), key=lambda x: int(x[0]))
+        else:
+            records = list(self.lookup(low, high))
+        # do not hold the database while waiting for the user
+        self.closedb()
+        old  = dict(records)
+        text = self.batch_text(records)
+        while True:
+            text = self.edit_content(data=text)
+            try:
+                parsed = self.batch_parse(text)
+                unknown = [k for k, f in parsed if k is not None and k not in old]
+                if unknown:
+                    raise ValueError('unknown key %s' % unknown[0])
+                break
+            except ValueError as e:
+                print(e)
+                default = 'y'
+                i = interact.readstr('edit again? [%s] ' % default, default)
+                if i not in ('y', 'Y'):
+                    return
+
+        kept    = set(k for k, f in parsed if k is not None)
+        deleted = [k for k in old if k not in kept]
+        added   = [f for k, f in parsed if k is None]
+        def differ(ent, fields):
+            # the document ends each content with a newline
+            return any(getattr(ent, name).rstrip('\n') != value.rstrip('\n')
+                            if name == 'content' else getattr(ent, name) != value
+                        for name, value in fields.items())
+        changed = [(k, f) for k, f in parsed if k is not None and differ(old[k], f)]
+        print('%s added, %s changed, %s deleted' % (len(added), len(changed), len(deleted)))
+        if not (added or changed or deleted):
+            return
+        default = 'n'
+        i = interact.readstr('apply? [%s] ' % default, default)
+        if i not in ('y', 'Y'):
+            return
+
+        def apply(cont):
+            for key in deleted:
+                if key in cont:
+                    self.drop(cont, key)
+            for key, fields in changed:
+                ent = cont[key]
+                for name, value in fields.items():
+                    setattr(ent, name, value)
+                self.put(cont, key, ent)
+            second = int(time.time())
+            for fields in added:
+                while str(second) in cont:
+                    second += 1
+                ent = Record()
+                ent.book = self.book_name
+                for name, value in fields.items():
+                    setattr(ent, name, value)
+                self.put(cont, str(second), ent)
+        self.transact(apply)
 
     def add(self):
         """ caller must supply the field names and
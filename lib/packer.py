@@ -0,0 +1,120 @@
+import os, sys, time
+import ZODB
+from zc.lockfile import LockError
+from recorder import Recorder
+from viewer import Viewer
+
+class Packer:
+    """ Pack the append-only FileStorages of logs, notes and
+    erratas, every save leaves the old revision of the record
+    in the file, packing drops them.
+
+    The automatic policy packs a database when it has grown
+    by 'pack_ratio' times since the last pack, or when the
+    last pack is older than 'pack_days' days. Nothing is done
+    while a viewing session is active.
+    """
+    state_key = 'pack_state'
+
+    def __init__(self, config):
+        self.config = config
+        self.paths  = [config.log_path, config.note_path, config.errata_path]
+        self.config_path = os.path.join(config.base_dir, config.config_file)
+
+    def busy(self):
+        """ return True if any viewing session is running
+        """
+        return bool(Viewer.active_sessions(self.config.base_dir))
+
+    def pack(self, paths=None):
+        """ Pack the given databases, or all of them
+        """
+        if self.busy():
+            print('viewing session active, not packing', file=sys.stderr)
+            return
+        paths = [x for x in (paths or self.paths) if os.path.exists(x)]
+        total = 0
+        for path in paths:
+            result = self.pack_one(path)
+            if result is None:
+                continue
+            before, after, open_before, open_after = result
+            total += before - after
+            print('%s: %s -> %s bytes (%s reclaimed), open %.3fs -> %.3fs' % (
+                    os.path.basename(path), before, after, before - after,
+                    open_before, open_after))
+        print('done, %s bytes reclaimed' % total)
+
+    def auto(self):
+        """ Pack the databases that are due according to the policy
+        """
+        if self.busy():
+            return
+        rec   = Recorder(self.config_path)
+        db    = rec.opendb()
+        state = db.get(self.state_key, {})
+        rec.closedb()
+        now   = int(time.time())
+        due   = []
+        for path in self.paths:
+            if not os.path.exists(path):
+                continue
+            name = os.path.basename(path)
+            size = os.path.getsize(path)
+            if name not in state:
+                self.record_state(name, size, now)
+                continue
+            last_time, last_size = state[name]
+            if (size >= last_size * self.config.pack_ratio or
+                    now - last_time >= self.config.pack_days * 86400):
+                due.append(path)
+        if due:
+            self.pack(due)
+
+    def pack_one(self, path):
+        """ pack one database, keep no old revisions, return the
+        sizes and the opening times before and after the packing,
+        or None if the database is in use.
+        """
+        before      = os.path.getsize(path)
+        open_before = self.open_time(path)
+        try:
+            db = ZODB.DB(path)
+        except LockError:
+            print('%s is in use, skipped' % path, file=sys.stderr)
+            return None
+        try:
+            db.pack()
+        finally:
+            db.close()
+        oldpath = path + '.old'
+        if os.path.exists(oldpath):
+            os.unlink(oldpath)
+        after       = os.path.getsize(path)
+        open_after  = self.open_time(path)
+        self.record_state(os.path.basename(path), after, int(time.time()))
+        return before, after, open_before, open_after
+
+    def open_time(self, path):
+        """ the seconds needed to open the database and load
+        every record of the main container.
+        """
+        start = time.time()
+        try:
+            rec = Recorder(path)
+            cont = rec.opendb()
+            for junk in cont.values():
+                pass
+            rec.closedb()
+        except LockError:
+            return float('nan')
+        return time.time() - start
+
+    def record_state(self, name, size, second):
+        rec   = Recorder(self.config_path)
+        db    = rec.opendb()
+        state = dict(db.get(self.state_key, {}))
+        state[name] = (second, size)
+        db[self.state_key] = state
+        rec.persist()
+        rec.closedb()
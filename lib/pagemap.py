@@ -0,0 +1,204 @@
+from bisect import bisect_right
+
+romans = [(1000, 'm'), (900, 'cm'), (500, 'd'), (400, 'cd'), (100, 'c'), (90, 'xc'),
+          (50, 'l'), (40, 'xl'), (10, 'x'), (9, 'ix'), (5, 'v'), (4, 'iv'), (1, 'i')]
+
+def to_roman(number):
+    if number <= 0:
+        return str(number)
+    text = ''
+    for value, letters in romans:
+        while number >= value:
+            text += letters
+            number -= value
+    return text
+
+def from_roman(text):
+    """ return the number of a roman numeral, None if it is not one
+    """
+    text = text.lower()
+    if not text or set(text) - set('mdclxvi'):
+        return None
+    number, i = 0, 0
+    for value, letters in romans:
+        while text.startswith(letters, i):
+            number += value
+            i += len(letters)
+    return number if i == len(text) else None
+
+class PageMap:
+    """ Translate between the physical page numbers of the book
+    file and the page labels printed on the pages.
+
+    The book is divided into ranges, each starts at a physical
+    page and has a style: decimal, roman ('r' lower, 'R' upper)
+    or none (unnumbered, e.g. plates). A range is written as
+    'physical:label', the ranges as a comma separated list:
+
+        1:r1,13:1,201:-,209:189
+
+    is roman front matter i-xii, then pages 1-188, 8 plates,
+    and pages 189 onward.
+
+    The reading log records page numbers, which must tell every
+    page of the book apart, so the labels, which may restart or
+    be missing, are what the user types and sees, the numbers
+    are what is stored. The number of a page is its physical
+    page less a fixed offset, taken so that the pages of the
+    first decimal range have their labels as numbers, e.g. 1-188
+    above, the plates are 189-196 and the pages labelled 189
+    onward are 197 onward. A book without labels has the offset
+    of the old setting 'page_num_diff'.
+
+    A label found in several ranges is taken from the first of
+    them, 'start:label' picks the range starting at the physical
+    page start, an unnumbered page is written '[physical]'.
+
+    The ranges are kept in sorted parallel lists, the range of
+    a physical page is found by bisection, and the decimal range
+    of a label by bisection of their first labels.
+    """
+    DECIMAL, LOWER, UPPER, NONE = range(4)
+
+    def __init__(self, ranges):
+        """ ranges is a list of (physical start, style, first label number)
+        """
+        ranges = sorted(ranges)
+        if not ranges or ranges[0][0] != 1:
+            raise ValueError('the first range must start at physical page 1')
+        self.starts = [x[0] for x in ranges]
+        self.styles = [x[1] for x in ranges]
+        self.firsts = [x[2] for x in ranges]
+        decimal = [i for i, x in enumerate(ranges) if x[1] == self.DECIMAL]
+        if not decimal:
+            raise ValueError('at least one decimal range is needed')
+        self.offset = self.starts[decimal[0]] - self.firsts[decimal[0]]
+        # decimal ranges ordered by their first label, for label -> physical
+        order = sorted(decimal, key=lambda i: (self.firsts[i], i))
+        self.dec_firsts = [self.firsts[i] for i in order]
+        self.dec_ranges = order
+
+    @classmethod
+    def parse(cls, spec):
+        ranges = []
+        for part in spec.split(','):
+            physical, label = part.strip().split(':')
+            physical = int(physical)
+            if label == '-':
+                ranges.append((physical, cls.NONE, 0))
+            elif label[:1] in ('r', 'R'):
+                style = cls.LOWER if label[0] == 'r' else cls.UPPER
+                ranges.append((physical, style, int(label[1:] or 1)))
+            else:
+                ranges.append((physical, cls.DECIMAL, int(label)))
+        return cls(ranges)
+
+    @classmethod
+    def from_diff(cls, page_num_diff):
+        """ the map of a book numbered from the physical page
+        page_num_diff + 1 on, as the old single offset.
+        """
+        return cls([(1, cls.DECIMAL, 1 - page_num_diff)])
+
+    def spec(self):
+        parts = []
+        for start, style, first in zip(self.starts, self.styles, self.firsts):
+            if style == self.NONE:
+                label = '-'
+            elif style == self.DECIMAL:
+                label = str(first)
+            else:
+                label = ('r' if style == self.LOWER else 'R') + str(first)
+            parts.append('%s:%s' % (start, label))
+        return ','.join(parts)
+
+    def end(self, i):
+        """ the physical page after range i, None for the last
+        """
+        return self.starts[i+1] if i + 1 < len(self.starts) else None
+
+    def index(self, physical):
+        """ the range of a physical page
+        """
+        return max(bisect_right(self.starts, physical) - 1, 0)
+
+    def label(self, physical):
+        """ the label printed on a physical page
+        """
+        i = self.index(physical)
+        style  = self.styles[i]
+        number = self.firsts[i] + physical - self.starts[i]
+        if style == self.DECIMAL:
+            return str(number)
+        if style == self.NONE:
+            return '[%s]' % physical
+        text = to_roman(number)
+        return text if style == self.LOWER else text.upper()
+
+    def physical(self, label):
+        """ the physical page of a label, ValueError if no page
+        has it.
+        """
+        text = str(label).strip()
+        if ':' in text:
+            start, text = text.split(':', 1)
+            if not start.isdigit():
+                raise ValueError('unknown page label: %s' % label)
+            i = self.index(int(start))
+            if self.starts[i] != int(start):
+                raise ValueError('no range starts at page %s' % start)
+            candidates = [i]
+        elif text.strip('-').isdigit():
+            # the decimal ranges whose first label is not above it, in book order
+            k = bisect_right(self.dec_firsts, int(text))
+            candidates = sorted(self.dec_ranges[:k])
+        else:
+            candidates = range(len(self.starts))
+        for i in candidates:
+            physical = self.find(i, text)
+            if physical is not None:
+                return physical
+        raise ValueError('unknown page label: %s' % label)
+
+    def find(self, i, text):
+        """ the physical page labelled text in range i, or None
+        """
+        style = self.styles[i]
+        if style == self.NONE:
+            if not (text.startswith('[') and text.endswith(']') and text[1:-1].isdigit()):
+                return None
+            physical = int(text[1:-1])
+            return physical if self.index(physical) == i else None
+        if style == self.DECIMAL:
+            if not text.strip('-').isdigit():
+                return None
+            number = int(text)
+        else:
+            number = from_roman(text)
+            if number is None:
+                return None
+        physical = self.starts[i] + number - self.firsts[i]
+        end = self.end(i)
+        if physical < self.starts[i] or (end is not None and physical >= end):
+            return None
+        return physical
+
+    def number(self, physical):
+        """ the page number used in the log for a physical page
+        """
+        return physical - self.offset
+
+    def page(self, number):
+        """ the physical page of a page number of the log
+        """
+        return max(number + self.offset, 1)
+
+    def number_of(self, label):
+        """ the page number of the log for a label
+        """
+        return self.number(self.physical(label))
+
+    def label_of(self, number):
+        """ the label of a page number of the log
+        """
+        return self.label(self.page(number))
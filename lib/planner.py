@@ -0,0 +1,86 @@
+import time, math
+
+class Planner:
+    """ Forecast the reading from the recent velocity.
+
+    The velocity is taken from the per day totals kept by the
+    logger, over the last 'window' days before today, starting
+    no earlier than the first day with a record:
+
+        velocity    : pages per calendar day, skipped days included
+        skip rate   : part of the days with no reading
+        pace        : pages per day actually read
+    """
+    window = 14
+
+    def __init__(self, logger, config):
+        self.logger = logger
+        self.config = config
+        self.today  = int(time.mktime(time.strptime(time.strftime('%Y-%m-%d'), '%Y-%m-%d')))
+        self.measure()
+
+    def measure(self):
+        days  = self.logger.day_totals()
+        last  = time.strftime('%Y-%m-%d', time.localtime(self.today - 86400))
+        first = time.strftime('%Y-%m-%d', time.localtime(self.today - self.window * 86400))
+        if len(days):
+            first = max(first, days.minKey())
+        recent = [pages for day, (pages, seconds) in days.items(min=first, max=last)]
+        span   = (self.today - time.mktime(time.strptime(first, '%Y-%m-%d'))) // 86400
+        span   = max(int(span), 1)
+        read   = len([x for x in recent if x > 0])
+        if read:
+            self.velocity  = sum(recent) / span
+            self.skip_rate = 1 - read / span
+            self.pace      = sum(recent) / read
+        else:
+            # no history, assume the plan is kept
+            self.velocity  = self.config.page_per_day
+            self.skip_rate = 0
+            self.pace      = self.config.page_per_day
+
+    def remaining(self, start_page, end_page):
+        return max(end_page - start_page + 1, 0)
+
+    def days_needed(self, remaining, rates):
+        """ days needed to read the remaining pages at each of the
+        daily rates, with the current skip rate, in one pass.
+        """
+        keep = 1 - self.skip_rate
+        return [math.ceil(remaining / (rate * keep)) if rate * keep > 0 else None
+                    for rate in rates]
+
+    def date(self, days):
+        return time.strftime('%Y-%m-%d', time.localtime(self.today + days * 86400))
+
+    def adaptive(self, start_page, end_page):
+        """ print the forecast and the schedule at the recent pace
+        """
+        remaining = self.remaining(start_page, end_page)
+        print('Velocity: %.1f pages/day, pace %.1f pages/reading day, %d%% days skipped' % (
+                self.velocity, self.pace, self.skip_rate * 100))
+        if self.velocity <= 0:
+            print('no reading recently, cannot forecast')
+            return
+        days = math.ceil(remaining / self.velocity)
+        print('Finish: %s (%s days, %s pages left)' % (self.date(days), days, remaining))
+        first = start_page
+        for day in range(days):
+            if first > end_page:
+                break
+            # the rest spread over the days left
+            target = math.ceil((end_page - first + 1) / (days - day))
+            last   = min(first + target - 1, end_page)
+            print('%s %s - %s' % (self.date(day), self.config.page_map.label_of(first),
+                                  self.config.page_map.label_of(last)))
+            first  = last + 1
+
+    def whatif(self, start_page, end_page, rates):
+        """ print the finish date for each of the pages per day
+        """
+        remaining = self.remaining(start_page, end_page)
+        for rate, days in zip(rates, self.days_needed(remaining, rates)):
+            if days is None:
+                print('%3s pages/day: never' % rate)
+            else:
+                print('%3s pages/day: %s (%s days)' % (rate, self.date(days), days))
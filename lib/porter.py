@@ -0,0 +1,159 @@
+import sys, csv, json
+from record import Record
+from logger import Logger, LogEntry
+from noter import Noter
+from errator import Errator
+
+def optint(value):
+    """ int, or None for an empty value
+    """
+    return None if value in (None, '') else int(value)
+
+def boolean(value):
+    if isinstance(value, str):
+        return value.lower() in ('1', 'true', 'yes', 'y')
+    return bool(value)
+
+class Porter:
+    """ Export the records of logs, notes or erratas to a JSONL
+    or CSV file, and import them back. Records are streamed one
+    by one in both directions, the connection cache is trimmed
+    after each batch, so memory use does not grow with the size
+    of the history.
+    """
+    batch_size = 10000
+
+    # fields of each kind of record, and the converter used
+    # to turn the value read from a file to the stored type
+    fields = {
+        'log': [
+            ('book_name',  str),
+            ('start_time', int),
+            ('end_time',   int),
+            ('start_page', int),
+            ('end_page',   optint),
+            ('complete',   boolean),
+            ('paused',     optint),
+        ],
+        'note': [
+            ('book',       str),
+            ('chapter',    int),
+            ('subject',    str),
+            ('content',    str),
+        ],
+        'errata': [
+            ('book',       str),
+            ('page',       str),
+            ('content',    str),
+        ],
+    }
+
+    def __init__(self, config, kind):
+        if kind == 'log':
+            self.recorder = Logger(config.log_path)
+            self.factory  = LogEntry
+        elif kind == 'note':
+            self.recorder = Noter(config.note_path, config.book_name)
+            self.factory  = Record
+        elif kind == 'errata':
+            self.recorder = Errator(config.errata_path, config.book_name)
+            self.factory  = Record
+        else:
+            raise ValueError('unknown kind: %s' % kind)
+        self.kind = kind
+
+    def names(self):
+        return ['key'] + [name for name, conv in self.fields[self.kind]]
+
+    def rows(self):
+        """ yield each record as a dictionary, in the key order
+        """
+        cont  = self.recorder.opendb()
+        names = self.names()[1:]
+        for count, (key, ent) in enumerate(cont.items(), 1):
+            row = {'key': key}
+            for name in names:
+                row[name] = getattr(ent, name, None)
+            yield row
+            if count % self.batch_size == 0:
+                self.recorder.conn.cacheGC()
+
+    def export(self, path):
+        """ write all records to the file, '-' for the stdout,
+        CSV if the file name ends with '.csv', JSONL otherwise.
+        """
+        file = sys.stdout if path == '-' else open(path, 'w', newline='')
+        count = 0
+        if path.endswith('.csv'):
+            writer = csv.DictWriter(file, self.names())
+            writer.writeheader()
+            for row in self.rows():
+                writer.writerow(row)
+                count += 1
+        else:
+            for row in self.rows():
+                file.write(json.dumps(row, ensure_ascii=False))
+                file.write('\n')
+                count += 1
+        if file is not sys.stdout:
+            file.close()
+        self.recorder.closedb()
+        print('done, %s records exported' % count, file=sys.stderr)
+
+    def read(self, path):
+        """ yield the rows in the file, '-' for the stdin
+        """
+        file = sys.stdin if path == '-' else open(path, newline='')
+        if path.endswith('.csv'):
+            yield from csv.DictReader(file)
+        else:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+        if file is not sys.stdin:
+            file.close()
+
+    def make(self, row):
+        """ make a record from a row
+        """
+        ent = self.factory()
+        for name, conv in self.fields[self.kind]:
+            setattr(ent, name, conv(row.get(name)))
+        return ent
+
+    def load(self, path):
+        """ import the records in the file, those whose key is
+        already in the database are skipped, the records are
+        committed every 'batch_size' records.
+        """
+        rec   = self.recorder
+        added = 0
+        batch = []
+
+        def write(cont):
+            count = 0
+            for key, ent in batch:
+                if key in cont:
+                    continue
+                rec.put(cont, key, ent)
+                count += 1
+            return count
+
+        def flush():
+            count = rec.transact(write)
+            rec.conn.cacheGC()
+            batch.clear()
+            return count
+
+        seen = 0
+        for row in self.read(path):
+            batch.append((str(row['key']), self.make(row)))
+            seen += 1
+            if len(batch) >= self.batch_size:
+                added += flush()
+        if batch:
+            added += flush()
+        rec.closedb()
+        skipped = seen - added
+        print('done, %s records imported, %s duplicates skipped' % (added, skipped),
+                file=sys.stderr)
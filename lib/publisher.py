@@ -0,0 +1,145 @@
+import os, sys, json, hashlib, html
+from noter import Noter
+from errator import Errator
+from timeutils import isotime
+
+class Publisher:
+    """ Render the notes grouped by chapter and the errata grouped
+    by pages into Markdown or HTML files in a directory.
+
+    The manifest file in the directory records, for each file,
+    the stamp of its group when it was rendered and the hash of
+    its content. A group whose stamp did not change is skipped
+    without loading its records, a rendered file is written only
+    when its content differs.
+    """
+    manifest_file = '.manifest.json'
+    formats = ('md', 'html')
+
+    def __init__(self, config, outdir, format='md'):
+        if format not in self.formats:
+            raise ValueError('unknown format: %s' % format)
+        self.config  = config
+        self.outdir  = outdir
+        self.format  = format
+        self.written = 0
+        self.skipped = 0
+
+    def publish(self):
+        if not os.path.isdir(self.outdir):
+            print('%s not exists, or is not a directory' % self.outdir, file=sys.stderr)
+            return
+        manifest_path = os.path.join(self.outdir, self.manifest_file)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as file:
+                manifest = json.load(file)
+        else:
+            manifest = {}
+        if manifest.get('format') != self.format:
+            manifest = {'format': self.format, 'files': {}}
+        self.files = manifest['files']
+
+        links = []
+        for kind, recorder in (('notes', Noter(self.config.note_path, self.config.book_name)),
+                               ('errata', Errator(self.config.errata_path, self.config.book_name))):
+            links += self.publish_kind(kind, recorder)
+            recorder.closedb()
+        self.write('index', self.render_index(links), None)
+
+        # an interrupted write leaves the old manifest whole
+        with open(manifest_path + '.tmp', 'w') as file:
+            json.dump(manifest, file, indent=1, sort_keys=True)
+        os.replace(manifest_path + '.tmp', manifest_path)
+        print('done, %s files written, %s unchanged' % (self.written, self.skipped))
+
+    def publish_kind(self, kind, recorder):
+        """ publish the changed groups of a kind of records,
+        return the (title, file name) of all groups.
+        """
+        # the indexes of an older store are built as it is opened
+        recorder.opendb()
+        stamps = recorder.opendb(recorder.stampsName)
+        index  = recorder.opendb(recorder.indexName)
+        links  = []
+        for group, stamp in stamps.items():
+            name, title = self.group_name(kind, group)
+            low, high = recorder.group_range(group)
+            if not len(index.keys(min=low, max=high)):
+                self.remove(name)
+                continue
+            links.append((title, name))
+            entry = self.files.get(name)
+            if entry and entry['stamp'] == stamp and os.path.exists(self.path(name)):
+                self.skipped += 1
+                continue
+            records = recorder.lookup(low, high)
+            self.write(name, self.render(kind, title, records), stamp)
+        return links
+
+    def group_name(self, kind, group):
+        """ the file name without suffix, and the title of a group
+        """
+        if kind == 'notes':
+            return 'notes/chapter-%03d' % group, 'Chapter %s' % group
+        if group < 0:
+            return 'errata/unnumbered', 'Errata, pages without number'
+        low, high = group * Errator.groupSize, (group + 1) * Errator.groupSize - 1
+        return 'errata/pages-%04d-%04d' % (low, high), 'Errata, pages %s-%s' % (low, high)
+
+    def path(self, name):
+        return os.path.join(self.outdir, '%s.%s' % (name, self.format))
+
+    def write(self, name, text, stamp):
+        """ write the file if the content changed
+        """
+        digest = hashlib.sha1(text.encode()).hexdigest()
+        entry  = self.files.get(name)
+        path   = self.path(name)
+        if not (entry and entry['hash'] == digest and os.path.exists(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as file:
+                file.write(text)
+            self.written += 1
+        else:
+            self.skipped += 1
+        self.files[name] = {'stamp': stamp, 'hash': digest}
+
+    def remove(self, name):
+        if name in self.files:
+            del self.files[name]
+        if os.path.exists(self.path(name)):
+            os.unlink(self.path(name))
+
+    def render(self, kind, title, records):
+        """ render the records of a group
+        """
+        sections = []
+        for key, ent in records:
+            heading = ent.subject if kind == 'notes' else 'Page %s' % ent.page
+            sections.append((heading, isotime(int(key)), ent.content))
+        if self.format == 'md':
+            parts = ['# %s\n' % title]
+            for heading, date, content in sections:
+                parts.append('## %s\n\n*%s*\n\n%s\n' % (heading, date, content.rstrip()))
+            return '\n'.join(parts)
+        parts = ['<h1>%s</h1>' % html.escape(title)]
+        for heading, date, content in sections:
+            parts.append('<h2>%s</h2>\n<p class="date">%s</p>\n<pre>%s</pre>' % (
+                html.escape(heading), date, html.escape(content.rstrip())))
+        return self.html_page(title, '\n'.join(parts))
+
+    def render_index(self, links):
+        title = self.config.book_name
+        if self.format == 'md':
+            lines = ['# %s\n' % title]
+            lines += ['- [%s](%s.md)' % (text, name) for text, name in links]
+            return '\n'.join(lines) + '\n'
+        items = ['<li><a href="%s.html">%s</a></li>' % (name, html.escape(text))
+                    for text, name in links]
+        body = '<h1>%s</h1>\n<ul>\n%s\n</ul>' % (html.escape(title), '\n'.join(items))
+        return self.html_page(title, body)
+
+    def html_page(self, title, body):
+        return ('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n'
+                '<title>%s</title>\n</head>\n<body>\n%s\n</body>\n</html>\n' % (
+                    html.escape(title), body))
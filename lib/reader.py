@@ -10,14 +10,26 @@ log records. It can also be used to preview the plan, take notes,
 log errata.
 """
 
-import sys, os, time
+import sys, os, time, shlex
 import interact
 from recorder import Recorder
+from timeutils import strtosecond, isotime
 from viewer import Viewer
+import supervisor
 from logger import Logger
 from noter import Noter
 from errator import Errator
 from sync import Synchronizer
+from packer import Packer
+from backup import Backup
+from porter import Porter
+from watcher import TodayWatcher
+from planner import Planner
+from publisher import Publisher
+from scanner import Scanner, pdf_info
+from pagemap import PageMap
+from schema import Migrator
+from checker import fsck
 
 class Config:
     """ Store the config info of the program,
@@ -27,6 +39,10 @@ class Config:
     defaultNotePath   = ".note"
     defaultErrataPath = ".errata"
     defaultPagePerDay = 18
+    defaultPackRatio  = 2
+    defaultPackDays   = 30
+    defaultCompactGap = 5
+    defaultViewerCommand = 'pv -p {page} {book}'
     config_file       = '.reading_settings'
 
     def __init__(self, basedir=None):
@@ -42,6 +58,11 @@ class Config:
             note_file  : note db base name
             errata_file: errata db base name
             init_done  : flag to signified if settings are set
+            pack_ratio : pack a db when it grows this many times
+            pack_days  : pack a db when last packed this many days ago
+            page_labels: page label ranges, overrides page_num_diff
+            compact_gap: merge logs less than this many minutes apart
+            viewer_command: program to view the book at {page}
 
         In database, store the base name of file, when loaded,
         the base directory will be added to build a full path,
@@ -60,7 +81,7 @@ class Config:
             rec.persist()
         self.load(db)
 
-        self.logger = Logger(self.log_path)
+        self.logger = Logger(self.log_path, page_map=self.page_map)
         rec.closedb()
 
     def config(self):
@@ -92,13 +113,66 @@ class Config:
             else:
                 return book_file
 
+    def getEndPage(self, book_file, page_map, default=None):
+        """ Get the label of the last page from user, return its
+        page number, the last page of the book is the default if
+        the page count can be read.
+        """
+        book_path = self.fixupBookPath(book_file)
+        if book_path.lower().endswith('.pdf'):
+            pages, title = pdf_info(book_path)
+            if pages:
+                default = page_map.number(pages)
+        if default is not None:
+            default = page_map.label_of(default)
+            prompt  = 'last page [%s]: ' % default
+        else:
+            prompt  = 'last page: '
+        while True:
+            try:
+                return page_map.number_of(interact.readstr(prompt, default))
+            except ValueError as e:
+                print(e, file=sys.stderr)
+
+    def getViewerCommand(self, default):
+        """ Get the command of the book viewer from user,
+        {page} and {book} in it are replaced when it is run.
+        """
+        prompt =  'viewer command, {page} and {book} are replaced\n'
+        prompt += '  [%s]: ' % default
+        while True:
+            command = interact.readstr(prompt, default)
+            try:
+                if '{page}' in command and shlex.split(command):
+                    return command
+            except ValueError:
+                pass
+            print('%s is not a command with {page} in it' % command, file=sys.stderr)
+
+    def set(self, **settings):
+        """ Change some settings, and load them
+        """
+        config_path = os.path.join(self.base_dir, self.config_file)
+        rec = Recorder(config_path)
+        db  = rec.opendb()
+        for name, value in settings.items():
+            db[name] = value
+        rec.persist()
+        self.load(db)
+        rec.closedb()
+
     def init(self, db):
         """ Initialize the settings interactively
         """
         print('Initial setting, please answer some questions')
         book_name   = interact.readstr('book name: ')
         book_file   = self.getBookFileName()
-        end_page    = interact.readint('last page number: ')
+
+        # defference between the actual page number and the page label
+        page_num_diff = interact.readint('page number of the first page label: ')
+        page_num_diff -= 1
+
+        end_page    = self.getEndPage(book_file, PageMap.from_diff(page_num_diff))
         default     = self.defaultLogPath
         log_file    = interact.readstr('basename of log file [%s]: ' % default, default)
         default     = self.defaultNotePath
@@ -114,9 +188,7 @@ class Config:
         prompt += '  the Viewer class, press Enter to continue '
         interact.readstr(prompt, '')
 
-        # defference between the actual page number and the page label
-        page_num_diff = interact.readint('page number of the first page label: ')
-        page_num_diff -= 1
+        viewer_command = self.getViewerCommand(self.defaultViewerCommand)
 
         # page per day
         default       = self.defaultPagePerDay
@@ -130,6 +202,7 @@ class Config:
         db['note_file']     = note_file
         db['errata_file']   = errata_file
         db['viewer_log']    = viewer_log
+        db['viewer_command'] = viewer_command
         db['page_num_diff'] = page_num_diff
         db['page_per_day']  = page_per_day
         db['init_done']     = True
@@ -155,6 +228,15 @@ class Config:
         self.errata_path    = os.path.join(self.base_dir, db['errata_file'])
         self.page_num_diff  = db['page_num_diff']
         self.page_per_day   = db['page_per_day']
+        self.page_labels    = db.get('page_labels')
+        if self.page_labels:
+            self.page_map   = PageMap.parse(self.page_labels)
+        else:
+            self.page_map   = PageMap.from_diff(self.page_num_diff)
+        self.pack_ratio     = db.get('pack_ratio', self.defaultPackRatio)
+        self.pack_days      = db.get('pack_days', self.defaultPackDays)
+        self.compact_gap    = db.get('compact_gap', self.defaultCompactGap)
+        self.viewer_command = db.get('viewer_command', self.defaultViewerCommand)
 
     def update(self, db):
         """ Update the settings interactively
@@ -166,9 +248,20 @@ class Config:
         default     = self.book_path
         book_file   = self.getBookFileName(default=default)
 
-        default     = self.end_page
-        prompt      = 'last page number [%s]: ' % default
-        end_page    = interact.readint(prompt, default)
+        # defference between the actual page number and the page label,
+        # the page label ranges replace it if they are set
+        if self.page_labels:
+            print('page labels: %s (change them by "labels")' % self.page_labels)
+            page_num_diff = self.page_num_diff
+            page_map      = self.page_map
+        else:
+            default       = self.page_num_diff + 1
+            prompt        = 'page number of the first page label [%s]: ' % default
+            page_num_diff = interact.readint(prompt, default)
+            page_num_diff -= 1
+            page_map      = PageMap.from_diff(page_num_diff)
+
+        end_page    = self.getEndPage(book_file, page_map, self.end_page)
 
         default     = os.path.basename(self.log_path)
         prompt      = 'basename of log file [%s]: ' % default
@@ -190,11 +283,7 @@ class Config:
         prompt += '  the Viewer class, press Enter to continue '
         interact.readstr(prompt, '')
 
-        # defference between the actual page number and the page label
-        default       = self.page_num_diff + 1
-        prompt        = 'page number of the first page label [%s]: ' % default
-        page_num_diff = interact.readint(prompt, default)
-        page_num_diff -= 1
+        viewer_command = self.getViewerCommand(self.viewer_command)
 
         # page per day
         default       = self.page_per_day
@@ -207,6 +296,7 @@ class Config:
         db['log_file']      = log_file
         db['note_file']     = note_file
         db['errata_file']   = errata_file
+        db['viewer_command'] = viewer_command
         db['page_num_diff'] = page_num_diff
         db['page_per_day']  = page_per_day
         db['init_done']     = True
@@ -226,20 +316,41 @@ class App:
         basename = os.path.basename(sys.argv[0])
         print('Usage:')
         print('%s read [page] [nolog] --  %s' % (basename, 'read the book'))
+        print('%s sessions [stop id|all]  --  %s' % (basename, 'list the reading sessions, or stop them'))
         print('%s log          --  %s' % (basename, 'add reading log'))
-        print('%s ll           --  %s' % (basename, 'list reading log'))
+        print('%s ll [--since time] [--until time] [--limit n]  --  %s' % (basename, 'list reading log'))
         print('%s dellast      --  %s' % (basename, 'delete the last log'))
         print('%s days         --  %s' % (basename, 'list summary of days'))
         print('%s cl           --  %s' % (basename, 'clear temporary reading log'))
         print('%s note         --  %s' % (basename, 'add note'))
+        print('%s note batch [from [to]]  --  %s' % (basename, 'edit notes of chapters in one editor session'))
         print('%s errata       --  %s' % (basename, 'collect errata'))
-        print('%s today        --  %s' % (basename, 'show today\'s statistics'))
+        print('%s errata batch [from [to]]  --  %s' % (basename, 'edit errata of pages in one editor session'))
+        print('%s today [--watch]  --  %s' % (basename, 'show today\'s statistics'))
+        print('%s chapter from [to]  --  %s' % (basename, 'show notes of the chapters'))
+        print('%s pages from [to]    --  %s' % (basename, 'show errata of the pages'))
+        print('%s reindex      --  %s' % (basename, 'rebuild the note and errata indexes'))
         print('%s sync dstdir  --  %s' % (basename, 'sync data to files in dstdir'))
+        print('%s scan dir [pick]  --  %s' % (basename, 'list the PDF books in dir, or pick one to read'))
+        print('%s publish outdir [md|html]  --  %s' % (basename, 'render notes and errata to files'))
+        print('%s export log|note|errata file  --  %s' % (basename, 'export records to JSONL or CSV (.csv)'))
+        print('%s import log|note|errata file  --  %s' % (basename, 'import records from JSONL or CSV (.csv)'))
         print('%s config       --  %s' % (basename, 'interactive configuring'))
+        print('%s labels [spec|-]  --  %s' % (basename, 'show or set the page label ranges, e.g. 1:r1,13:1'))
+        print('%s pack         --  %s' % (basename, 'drop old revisions from the databases'))
+        print('%s changes log|note|errata [--since seq] [--consumer name]  --  %s' % (basename, 'list the changes of the records'))
+        print('%s changes log|note|errata trim  --  %s' % (basename, 'drop the changes every consumer has seen'))
+        print('%s compact [minutes|undo [--force]]  --  %s' % (basename, 'merge logs with short breaks between, or undo it'))
+        print('%s fsck [repair]  --  %s' % (basename, 'check the stored data, and fix what can be fixed'))
+        print('%s migrate [batches]  --  %s' % (basename, 'upgrade the stored records to the current format'))
+        print('%s backup dstdir [restore outdir]  --  %s' % (basename, 'incremental backup, or rebuild a full copy'))
         print('%s plan [date spage epage numpage]  --  %s' % (basename, 'show reading plan'))
+        print('%s plan adaptive  --  %s' % (basename, 'show reading plan at the recent velocity'))
+        print('%s plan whatif numpage...  --  %s' % (basename, 'show finish dates of pages per day'))
 
     def read(self, *args):
-        """ Open the reader in the background
+        """ Open the reader in the background, the session
+        supervisor runs the viewer and logs the session.
         """
         args = list(args)
         take_log = True    # if log automatically
@@ -248,21 +359,75 @@ class App:
             if 'nolog' in args:
                 take_log = False
                 args.remove('nolog')
-            if len(args) and args[0].isdigit():
-                start_page = int(args[0])
-        if os.fork() == 0:
-            os.setsid()
-            Viewer(self.logger, self.config, start_page, take_log)
-        
+            if len(args):
+                try:
+                    start_page = self.config.page_map.number_of(args[0])
+                except ValueError as e:
+                    print(e, file=sys.stderr)
+                    exit(1)
+        self.logger.closedb()
+        reply = supervisor.request(self.config,
+                    {'op': 'read', 'page': start_page, 'log': take_log}, start=True)
+        if 'error' in reply:
+            print(reply['error'], file=sys.stderr)
+            exit(1)
+
+    def sessions(self, *args):
+        """ List the running reading sessions, or stop one or all
+        """
+        if args and (args[0] != 'stop' or len(args) != 2 or
+                        not (args[1].isdigit() or args[1] == 'all')):
+            self.help()
+            exit(1)
+        reply = supervisor.request(self.config, {'op': 'list'})
+        sessions = reply['sessions'] if reply else []
+        if not args:
+            for x in sessions:
+                start = time.strftime('%Y-%m-%d %H:%M', time.localtime(x['start_time']))
+                page  = self.config.page_map.label_of(x['start_page'])
+                print('%s: [%s] from page %s, pid %s' % (x['id'], start, page, x['pid']))
+            if not sessions:
+                print('no session')
+            return
+        ids = [x['id'] for x in sessions] if args[1] == 'all' else [int(args[1])]
+        for id in ids:
+            reply = supervisor.request(self.config, {'op': 'stop', 'id': id}) or {'error': 'no session'}
+            if 'error' in reply:
+                print(reply['error'], file=sys.stderr)
+
     def clear_log(self):
         """ Clear the temporary log entries from the main log database
         """
         self.logger.clear_tmp_log()
 
-    def list_log(self):
-        """ List all complete log entries
+    def options(self, args, names):
+        """ Parse the '--name value' options in the args, return
+        a dictionary of the given names, None for the missing ones.
+        """
+        res  = dict.fromkeys(names)
+        args = list(args)
+        while args:
+            arg = args.pop(0)
+            name = arg[2:]
+            if not arg.startswith('--') or name not in names or not args:
+                self.help()
+                exit(1)
+            res[name] = args.pop(0)
+        return res
+
+    def list_log(self, *args):
+        """ List the complete log entries, optionally the ones
+        in a time range, or only the first some of them.
         """
-        self.logger.list()
+        opts  = self.options(args, ['since', 'until', 'limit'])
+        since = strtosecond(opts['since']) if opts['since'] else None
+        until = None
+        if opts['until']:
+            until = strtosecond(opts['until'])
+            if ':' not in opts['until']:
+                until += 86400 - 1      # the whole day
+        limit = int(opts['limit']) if opts['limit'] else None
+        self.logger.list(since, until, limit)
 
     def list_sum(self):
         """ List summaries of all complete log entries by days
@@ -274,6 +439,8 @@ class App:
         """
         # use the tmp log record if any
         tmplogs = self.logger.fetch_tmplogs()
+        # do not hold the database while waiting for the user
+        self.logger.closedb()
         if tmplogs:
             ent = interact.printAndPick(tmplogs)
             if ent:
@@ -297,8 +464,13 @@ class App:
         if no day given, use the current day.
         """
         second = time.mktime(time.strptime(day, '%Y-%m-%d')) if day else time.time()
-        start_page = int(start_page) if start_page else self.logger.cal_start_page()
-        end_page = int(end_page) if end_page else self.config.end_page
+        page_map   = self.config.page_map
+        try:
+            start_page = page_map.number_of(start_page) if start_page else self.logger.cal_start_page()
+            end_page   = page_map.number_of(end_page) if end_page else self.config.end_page
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            exit(1)
         if page_per_day:
             page_per_day = int(page_per_day)
         else:
@@ -311,26 +483,91 @@ class App:
                     last_of_day = end_page
                     end = True
                 text = time.strftime('%Y-%m-%d', time.localtime(second))
-                text = '%s %s - %s' % (text, first_of_day, last_of_day)
+                text = '%s %s - %s' % (text, page_map.label_of(first_of_day),
+                                       page_map.label_of(last_of_day))
                 yield text
                 first_of_day = last_of_day + 1
                 second += 86400     # the next day
         for line in producer(start_page, second):
             print(line)
 
-    def note(self):
-        """ Add notes to the notes database
+    def forecast(self, mode, *rates):
+        """ Show the plan from the recent reading velocity, or the
+        finish dates for some numbers of pages per day.
+        """
+        planner    = Planner(self.logger, self.config)
+        start_page = self.logger.cal_start_page()
+        end_page   = self.config.end_page
+        if mode == 'adaptive':
+            planner.adaptive(start_page, end_page)
+        else:
+            rates = [int(x) for x in rates if x]
+            if not rates:
+                self.help()
+                exit(1)
+            planner.whatif(start_page, end_page, rates)
+
+    def note(self, *args):
+        """ Add notes to the notes database, or edit the
+        notes of some chapters in batch.
         """
         noteObj = Noter(self.config.note_path, self.config.book_name)
-        actions = ['add', 'list', 'edit', 'delete']
+        if args:
+            self.batch(noteObj, *args)
+            return
+        actions = ['add', 'list', 'edit', 'delete', 'batch']
         picked  = interact.printAndPick(actions, lineMode=True)
         func    = getattr(noteObj, picked[1])
         func()
+        noteObj.closedb()
 
-    def errata(self):
-        """ Add errata record to the errata database
+    def errata(self, *args):
+        """ Add errata record to the errata database, or edit
+        the errata of some pages in batch.
         """
-        Errator(self.config.errata_path, self.config.book_name).add()
+        errObj = Errator(self.config.errata_path, self.config.book_name)
+        if args:
+            self.batch(errObj, *args)
+            return
+        errObj.add()
+        errObj.closedb()
+
+    def batch(self, recorder, *args):
+        """ Edit the records of a range in one editor session
+        """
+        if args[0] != 'batch' or not all(x.isdigit() for x in args[1:3]):
+            self.help()
+            exit(1)
+        recorder.batch(*[int(x) for x in args[1:3]])
+        recorder.closedb()
+
+    def chapter(self, *args):
+        """ Show the notes of a chapter, or a range of chapters
+        """
+        if len(args) < 1 or not all(x.isdigit() for x in args[:2]):
+            self.help()
+            exit(1)
+        noteObj = Noter(self.config.note_path, self.config.book_name)
+        noteObj.query(*[int(x) for x in args[:2]])
+        noteObj.closedb()
+
+    def pages(self, *args):
+        """ Show the errata of a page, or a range of pages
+        """
+        if len(args) < 1 or not all(x.isdigit() for x in args[:2]):
+            self.help()
+            exit(1)
+        errObj = Errator(self.config.errata_path, self.config.book_name)
+        errObj.query(*[int(x) for x in args[:2]])
+        errObj.closedb()
+
+    def reindex(self):
+        """ Rebuild the indexes of the notes and errata
+        """
+        for obj in (Noter(self.config.note_path, self.config.book_name),
+                    Errator(self.config.errata_path, self.config.book_name)):
+            obj.reindex()
+            obj.closedb()
 
     def sync(self, *args):
         if len(args) < 1:
@@ -338,25 +575,30 @@ class App:
             exit(1)
         Synchronizer(self.config, args[0])
 
-    def today(self):
-        """ Show statistics of today
+    def today(self, *args):
+        """ Show statistics of today, keep updating them
+        while reading if '--watch' is given.
         """
+        if args and args[0] == '--watch':
+            self.logger.closedb()
+            TodayWatcher(self.logger, self.config, self.show_today).watch()
+            return
+
         # pull all logs of today, print statistics
         first_second = int(time.mktime(time.strptime(time.strftime('%Y-%m-%d'), '%Y-%m-%d')))
-        last_second  = first_second + 86400
-        db = self.logger.opendb()
-        valid = lambda x: first_second <= int(x) <= last_second
-        keys = [k for k in db if valid(k) and db[k].complete]
-
+        last_second  = first_second + 86400 - 1
         spent_time = 0
         page_count = 0
-        for key in keys:
-            ent = db[key]
-            spent_time += (ent.end_time - ent.start_time)
+        for ent in self.logger.iter_complete(first_second, last_second):
+            spent_time += ent.duration()
             page_count += (ent.end_page - ent.start_page)
 
-        # get the start page, page_per_day
-        start_page      = self.logger.cal_start_page() - page_count
+        start_page = self.logger.cal_start_page() - page_count
+        self.show_today(start_page, page_count, spent_time)
+
+    def show_today(self, start_page, page_count, spent_time):
+        """ Print the task, the pages and the time of today
+        """
         page_per_day    = self.config.page_per_day
         end_page        = start_page + page_per_day
 
@@ -365,13 +607,190 @@ class App:
         dura_m    = (spent_time % 3600) // 60
         dura_s    = spent_time % 60
         time_str  = '%s:%s:%s' % (dura_h, dura_m, dura_s)
-        print('Task: %s-%s (%s pages)' % (start_page, end_page, page_per_day))
+        page_map        = self.config.page_map
+        print('Task: %s-%s (%s pages)' % (page_map.label_of(start_page),
+                                          page_map.label_of(end_page), page_per_day))
         print('Page: %s/%s (%s)' % (page_count, page_per_day, stat_text))
         print('Time: %s spent' % time_str)
 
+    def labels(self, *args):
+        """ Show the page label ranges, or set them, '-' to
+        go back to the single page_num_diff offset.
+        """
+        if args:
+            spec = '' if args[0] == '-' else args[0]
+            try:
+                spec and PageMap.parse(spec)
+            except ValueError as e:
+                print('bad page labels: %s' % e, file=sys.stderr)
+                exit(1)
+            self.config.set(page_labels=spec)
+        page_map = self.config.page_map
+        print(page_map.spec())
+        # the commands take the labels, the log stores the numbers
+        for start, end in zip(page_map.starts, page_map.starts[1:] + [None]):
+            last   = '%s' % page_map.label(end - 1) if end else ''
+            number = '%s - %s' % (page_map.number(start), page_map.number(end - 1) if end else '')
+            print('  %5s: %s - %s  (page %s)' % (start, page_map.label(start), last, number))
+
+    def scan(self, *args):
+        """ List the PDF books in a directory, with 'pick', set
+        the book file and the last page from the picked one.
+        """
+        if len(args) < 1 or not os.path.isdir(args[0]) or list(args[1:2]) not in ([], ['pick']):
+            self.help()
+            exit(1)
+        books = Scanner(self.config).scan(args[0])
+        lines = ['%5s  %s\n       %s' % (pages or '?', title or '', path)
+                    for path, pages, title in books]
+        if len(args) < 2:
+            for line in lines:
+                print(line)
+            return
+        if not books:
+            return
+        idx, junk = interact.printAndPick(lines, lineMode=True)
+        if idx is None:
+            return
+        path, pages, title = books[idx]
+        settings = dict(book_file=path)
+        if pages:
+            # the page count is the last physical page
+            settings['end_page'] = self.config.page_map.number(pages)
+        self.config.set(**settings)
+        print('book file: %s, last page: %s' % (path, self.config.page_map.label_of(self.config.end_page)))
+
+    def publish(self, *args):
+        """ Render the notes and errata to files in a directory
+        """
+        if len(args) < 1 or list(args[1:2]) not in ([], ['md'], ['html']):
+            self.help()
+            exit(1)
+        Publisher(self.config, *args[:2]).publish()
+
+    def export(self, *args):
+        """ Export the records of a kind to a file
+        """
+        if len(args) < 2 or args[0] not in Porter.fields:
+            self.help()
+            exit(1)
+        self.logger.closedb()
+        Porter(self.config, args[0]).export(args[1])
+
+    def load(self, *args):
+        """ Import the records of a kind from a file
+        """
+        if len(args) < 2 or args[0] not in Porter.fields:
+            self.help()
+            exit(1)
+        self.logger.closedb()
+        Porter(self.config, args[0]).load(args[1])
+
     def dellast(self):
         self.logger.dellast()
 
+    def backup(self, *args):
+        """ Backup the new data to dstdir, or restore
+        full copies from the backup in dstdir to outdir.
+        """
+        if len(args) < 1 or (len(args) > 1 and (args[1] != 'restore' or len(args) < 3)):
+            self.help()
+            exit(1)
+        backup = Backup(self.config, args[0])
+        if len(args) > 1:
+            backup.restore(args[2])
+        else:
+            backup.backup()
+
+    def recorder(self, kind):
+        if kind == 'log':
+            return self.logger
+        if kind == 'note':
+            return Noter(self.config.note_path, self.config.book_name)
+        if kind == 'errata':
+            return Errator(self.config.errata_path, self.config.book_name)
+        self.help()
+        exit(1)
+
+    def changes(self, *args):
+        """ List the changes after a sequence number, or after
+        the last one the named consumer has seen, and record
+        that it has seen them. Or trim the changes seen by all.
+        """
+        if not args:
+            self.help()
+            exit(1)
+        rec = self.recorder(args[0])
+        if args[1:] == ('trim',):
+            print('done, %s changes removed' % rec.trim())
+            return
+        opts  = self.options(args[1:], ['since', 'consumer'])
+        since = int(opts['since']) if opts['since'] else None
+        if since is None:
+            since = rec.position(opts['consumer']) if opts['consumer'] else 0
+        last  = None
+        for seq, second, op, cont, key in rec.changes(since):
+            print('%s %s %s %s %s' % (seq, isotime(second), op, cont, key))
+            last = seq
+        rec.closedb()
+        if opts['consumer'] and last is not None:
+            rec.ack(opts['consumer'], last)
+
+    def compact(self, *args):
+        """ Merge the logs read in one go with short breaks,
+        or undo the last compaction.
+        """
+        if args in (('undo',), ('undo', '--force')):
+            try:
+                count = self.logger.uncompact(force=len(args) == 2)
+            except ValueError as e:
+                print('%s, undo with --force to restore anyway' % e, file=sys.stderr)
+                exit(1)
+            if count is None:
+                print('nothing to undo', file=sys.stderr)
+                exit(1)
+            print('done, %s logs restored' % count)
+            return
+        if args and not args[0].isdigit():
+            self.help()
+            exit(1)
+        gap = int(args[0]) if args else self.config.compact_gap
+        removed = self.logger.compact(gap * 60)
+        print('done, %s logs removed' % removed)
+
+    def pack(self):
+        """ Pack all databases now
+        """
+        self.logger.closedb()
+        Packer(self.config).pack()
+
+    def fsck(self, *args):
+        """ Check all databases, repair them if 'repair' is given
+        """
+        if args not in ((), ('repair',)):
+            self.help()
+            exit(1)
+        self.logger.closedb()
+        if fsck(self.config, repair=bool(args)):
+            exit(1)
+
+    def migrators(self):
+        return [Migrator(self.logger, 'log'),
+                Migrator(Noter(self.config.note_path, self.config.book_name), 'note'),
+                Migrator(Errator(self.config.errata_path, self.config.book_name), 'errata')]
+
+    def migrate(self, *args):
+        """ Upgrade the records of all databases, at most
+        the given number of batches of each, all if omitted.
+        """
+        if args and not args[0].isdigit():
+            self.help()
+            exit(1)
+        batches = int(args[0]) if args else None
+        for migrator in self.migrators():
+            migrator.run(batches)
+            migrator.recorder.closedb()
+
     def run(self, args):
         """ Args is the arguments from the command line
         """
@@ -379,15 +798,41 @@ class App:
             'read'    : (lambda: self.read(*args[2:])),
             'log'     : self.log,
             'cl'      : self.clear_log,
-            'll'      : self.list_log,
+            'll'      : (lambda: self.list_log(*args[2:])),
             'days'    : self.list_sum,
-            'note'    : self.note,
-            'today'   : self.today,
+            'note'    : (lambda: self.note(*args[2:])),
+            'today'   : (lambda: self.today(*args[2:])),
             'dellast' : self.dellast,
-            'plan'    : (lambda: self.plan(*args[2:])),
-            'errata'  : self.errata,
+            'plan'    : (lambda: self.forecast(*args[2:])
+                            if args[2:3] in (['adaptive'], ['whatif'])
+                            else self.plan(*args[2:])),
+            'errata'  : (lambda: self.errata(*args[2:])),
             'sync'    : (lambda: self.sync(*args[2:])),
+            'chapter' : (lambda: self.chapter(*args[2:])),
+            'pages'   : (lambda: self.pages(*args[2:])),
+            'reindex' : self.reindex,
+            'export'  : (lambda: self.export(*args[2:])),
+            'publish' : (lambda: self.publish(*args[2:])),
+            'scan'    : (lambda: self.scan(*args[2:])),
+            'labels'  : (lambda: self.labels(*args[2:])),
+            'import'  : (lambda: self.load(*args[2:])),
             'config'  : self.config.config,
+            'pack'    : self.pack,
+            'migrate' : (lambda: self.migrate(*args[2:])),
+            'fsck'    : (lambda: self.fsck(*args[2:])),
+            'compact' : (lambda: self.compact(*args[2:])),
+            'changes' : (lambda: self.changes(*args[2:])),
+            'sessions': (lambda: self.sessions(*args[2:])),
+            'backup'  : (lambda: self.backup(*args[2:])),
         }
         action = action_map.get(args[1], self.help)
         action()
+
+        # after writing, carry on an unfinished migration by one
+        # batch, and pack the databases which grow too much
+        if args[1] in ('log', 'cl', 'dellast', 'note', 'errata', 'import', 'compact'):
+            for migrator in self.migrators():
+                if not migrator.done():
+                    migrator.step()
+                migrator.recorder.closedb()
+            Packer(self.config).auto()
@@ -1,3 +1,18 @@
+import schema
+
 class Record:
     """ An empty namespace for a record
+
+    A record loaded from the database is upgraded to the current
+    version of its format, '_upgraded' tells that it was older,
+    it is not stored (see schema).
     """
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if schema.upgrade(self):
+            self._upgraded = True
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop('_upgraded', None)
+        return state
@@ -1,14 +1,43 @@
 import interact
+import schema
+from record import Record
 import ZODB, transaction
 from BTrees.OOBTree import OOBTree
+from ZODB.POSException import ConflictError
+from zc.lockfile import LockError
+import os, sys, time, random, contextlib
+from itertools import islice
 
 class Recorder:
     """ A class for managing simple records.
     The records stored in a dictionary like manner,
     that is, one key, one value, ZODB is used.
+
+    The records of a journaled recorder are changed through put
+    and drop, each change is appended to the 'changes' container
+    in the same transaction as (time, op, container, key) under
+    a sequence number, so a consumer, e.g. a mirror or an index,
+    can process only the changes after the last one it has seen.
+    The writes which keep the content, e.g. the records stored
+    again in a newer format, are made unjournaled.
+    The 'consumers' container records the last change each named
+    consumer has processed, the changes all of them have seen can
+    be trimmed.
+
+    A FileStorage can be opened by one process at a time, and
+    commits of different connections may conflict, so opening
+    the database and committing are retried, with an increasing
+    delay between the tries, up to 'retries' times.
     """
 
-    contName = 'main'
+    contName      = 'main'
+    journaled     = False
+    journaling    = True    # False while unjournaled
+    changesName   = 'changes'
+    consumersName = 'consumers'
+    retries       = 10
+    backoff       = 0.05    # first delay in seconds, doubled on each try
+    max_wait      = 2
 
     def __init__(self, db_path, contName=None):
         self.db_path    = db_path
@@ -21,23 +50,84 @@ class Recorder:
         return the required container.
         """
         if self.conn is None:
-            self.conn = ZODB.connection(self.db_path)
+            self.conn = self.connect()
+            self.containers = {}
         if contName is None:
+            if self.journaled:
+                # creating them commits, not in the middle of a change
+                self.container(self.changesName)
+                self.container(self.consumersName)
             contName = self.contName
         if contName is None:
             raise "must specify a container name"
-        return self.getContainer(self.conn.root, contName)
+        return self.container(contName)
+
+    def container(self, contName):
+        """ the containers are looked up once per connection
+        """
+        cont = self.containers.get(contName)
+        if cont is None:
+            cont = self.containers[contName] = self.getContainer(self.conn.root, contName)
+        return cont
+
+    def delay(self, attempt):
+        """ seconds to wait before the given retry, with jitter
+        so that the waiting processes do not wake up together.
+        """
+        delay = min(self.backoff * 2 ** (attempt - 1), self.max_wait)
+        return delay * random.uniform(0.5, 1.5)
+
+    def connect(self):
+        """ Open the database, wait for the other process
+        to release it if it is locked.
+        """
+        attempt = 0
+        while True:
+            try:
+                return ZODB.connection(self.db_path)
+            except LockError:
+                attempt += 1
+                if attempt > self.retries:
+                    print(self.lock_info(), file=sys.stderr)
+                    raise
+                time.sleep(self.delay(attempt))
+
+    def lock_info(self):
+        """ describe who holds the lock of the database
+        """
+        lock_path = self.db_path + '.lock'
+        try:
+            pid = open(lock_path).read().strip()
+        except OSError:
+            pid = ''
+        if not pid.isdigit():
+            return '%s is locked by an unknown process' % self.db_path
+        try:
+            os.kill(int(pid), 0)
+            state = 'running'
+        except ProcessLookupError:
+            state = 'not running'
+        except PermissionError:
+            state = 'running as another user'
+        return '%s is locked by process %s (%s), lock file: %s' % (
+                    self.db_path, pid, state, lock_path)
 
     def getContainer(self, root, contName):
         """ return a ZODB container, create it if not yet exists
         """
         cont = getattr(root, contName, None)
         if cont is None:
-            cont = OOBTree()
+            cont = self.newContainer(contName)
             setattr(root, contName, cont)
             transaction.commit()
         return cont
 
+    def newContainer(self, contName):
+        """ the empty container, a subclass may use another
+        kind of tree for some of its containers.
+        """
+        return OOBTree()
+
     def closedb(self):
         if self.conn:
             self.conn.close()
@@ -48,18 +138,131 @@ class Recorder:
         """
         transaction.commit()
 
-    def save(self, key, ent, contName=None):
-        cont = self.opendb(contName=contName)
+    def abort(self):
+        """ Drop the changes of the current transaction
+        """
+        transaction.abort()
+
+    def transact(self, func, contName=None):
+        """ Call func with the container and commit, the whole
+        is redone if the commit conflicts with another connection.
+        Return what func returns, the changes are dropped if it
+        fails.
+        """
+        attempt = 0
+        while True:
+            cont = self.opendb(contName=contName)
+            try:
+                result = func(cont)
+                self.persist()
+                return result
+            except ConflictError:
+                self.abort()
+                attempt += 1
+                if attempt > self.retries:
+                    print('%s: giving up after %s conflicts' % (self.db_path, attempt),
+                            file=sys.stderr)
+                    raise
+                time.sleep(self.delay(attempt))
+            except BaseException:
+                self.abort()
+                raise
+
+    def put(self, cont, key, ent):
+        """ Store the record in the container, within the current
+        transaction, subclass extends it to maintain derived data.
+        A record is stored in the current version of its format.
+        """
+        if isinstance(ent, Record):
+            schema.upgrade(ent)
+            ent.__dict__.pop('_upgraded', None)
         cont[key] = ent
-        self.persist()
+        self.journal('put', cont, key)
+
+    def drop(self, cont, key):
+        """ Remove the record from the container, within the
+        current transaction.
+        """
+        del cont[key]
+        self.journal('drop', cont, key)
+
+    @contextlib.contextmanager
+    def unjournaled(self):
+        """ the changes made within are not journaled
+        """
+        self.journaling = False
+        try:
+            yield
+        finally:
+            self.journaling = True
+
+    def journal(self, op, cont, key):
+        """ append a change of a record to the journal, the
+        sequence numbers go on after the trimmed changes.
+        """
+        if not (self.journaled and self.journaling):
+            return
+        names     = [name for name, x in self.containers.items() if x is cont]
+        changes   = self.opendb(self.changesName)
+        consumers = self.opendb(self.consumersName)
+        last = changes.maxKey() if changes else 0
+        if consumers:
+            last = max(last, max(consumers.values()))
+        changes[last + 1] = (int(time.time()), op, names[0] if names else self.contName, key)
+
+    def changes(self, since=0):
+        """ yield (seq, time, op, container, key) of the changes
+        after the sequence number since, in order.
+        """
+        changes = self.opendb(self.changesName)
+        for count, (seq, change) in enumerate(changes.items(min=since, excludemin=True), 1):
+            yield (seq,) + change
+            if count % 10000 == 0:
+                self.conn.cacheGC()
+
+    def position(self, consumer):
+        """ the last change the consumer has processed
+        """
+        return self.opendb(self.consumersName).get(consumer, 0)
+
+    def ack(self, consumer, seq):
+        """ record that the consumer has processed the changes up to seq
+        """
+        def ack(consumers):
+            consumers[consumer] = max(consumers.get(consumer, 0), seq)
+        self.transact(ack, self.consumersName)
+
+    def forget(self, consumer):
+        self.transact(lambda consumers: consumers.pop(consumer, None), self.consumersName)
+
+    def trim(self, batch_size=10000):
+        """ remove the changes every consumer has processed, in
+        batches of one transaction each, return the number removed.
+        """
+        consumers = self.opendb(self.consumersName)
+        if not consumers:
+            return 0
+        upto    = min(consumers.values())
+        removed = 0
+        while True:
+            def remove(changes):
+                keys = list(islice(changes.keys(max=upto), batch_size))
+                for seq in keys:
+                    del changes[seq]
+                return len(keys)
+            count = self.transact(remove, self.changesName)
+            removed += count
+            if count < batch_size:
+                return removed
+
+    def save(self, key, ent, contName=None):
+        self.transact(lambda cont: self.put(cont, key, ent), contName)
 
     def add(self, key, ent):
         self.save(key, ent)
 
     def delete(self, key):
-        cont = self.opendb()
-        del cont[key]
-        self.persist()
+        self.transact(lambda cont: self.drop(cont, key))
 
     def search(self, filter):
         # filter is a function takes two arguments, and returns Boolean
@@ -0,0 +1,357 @@
+"""
+Read the page count and the title of PDF files, without external
+tools. The cross reference of the file is followed from the trailer
+to the catalog and the page tree, both classic xref tables and
+xref streams (PDF 1.5) are understood. Files that can't be parsed
+this way are searched for the page tree nodes.
+"""
+
+import os, re, sys, zlib
+from concurrent.futures import ProcessPoolExecutor
+from recorder import Recorder
+
+ref_re   = rb'\s+(\d+)\s+(\d+)\s+R'
+int_re   = rb'\s*(\d+)(?!\d)(?!\s+\d+\s+R)'
+
+def find_ref(data, name):
+    match = re.search(b'/' + name + ref_re, data)
+    return int(match.group(1)) if match else None
+
+def find_int(data, name):
+    match = re.search(b'/' + name + int_re, data)
+    return int(match.group(1)) if match else None
+
+def literal_string(data, start):
+    """ return the bytes of the literal string starting at the
+    '(' at data[start], escapes and nested parentheses handled.
+    """
+    result = bytearray()
+    depth  = 0
+    i = start
+    while i < len(data):
+        c = data[i:i+1]
+        if c == b'\\':
+            nxt = data[i+1:i+2]
+            escapes = {b'n': b'\n', b'r': b'\r', b't': b'\t', b'b': b'\b', b'f': b'\f'}
+            if nxt in escapes:
+                result += escapes[nxt]
+            elif nxt.isdigit():
+                octal = re.match(rb'[0-7]{1,3}', data[i+1:i+4]).group()
+                result.append(int(octal, 8) & 0xff)
+                i += len(octal) - 1
+            elif nxt not in (b'\n', b'\r'):
+                result += nxt
+            i += 2
+            continue
+        if c == b'(':
+            depth += 1
+            if depth == 1:
+                i += 1
+                continue
+        elif c == b')':
+            depth -= 1
+            if depth == 0:
+                break
+        result += c
+        i += 1
+    return bytes(result)
+
+def decode_text(raw):
+    """ decode a PDF text string, UTF-16 with BOM or PDFDocEncoding,
+    approximated by latin-1.
+    """
+    if raw[:2] == b'\xfe\xff':
+        return raw[2:].decode('utf-16-be', 'replace')
+    if raw[:3] == b'\xef\xbb\xbf':
+        return raw[3:].decode('utf-8', 'replace')
+    return raw.decode('latin-1')
+
+def find_text(data, name):
+    match = re.search(b'/' + name + rb'\s*([(<])', data)
+    if not match:
+        return None
+    if match.group(1) == b'(':
+        raw = literal_string(data, match.start(1))
+    else:
+        end = data.index(b'>', match.start(1))
+        hexstr = re.sub(rb'\s', b'', data[match.start(1)+1:end])
+        if len(hexstr) % 2:
+            hexstr += b'0'
+        raw = bytes.fromhex(hexstr.decode())
+    return decode_text(raw)
+
+class PDFReader:
+    """ Minimal reader of the objects of a PDF file
+    """
+    chunk = 8192
+
+    def __init__(self, path):
+        self.file    = open(path, 'rb')
+        self.offsets = {}       # object number -> file offset
+        self.packed  = {}       # object number -> (stream object number, index)
+        self.streams = {}       # object stream number -> decoded objects
+        self.trailer = b''
+        self.read_xref()
+
+    def close(self):
+        self.file.close()
+
+    def read_at(self, offset, size):
+        self.file.seek(offset)
+        return self.file.read(size)
+
+    def read_xref(self):
+        self.file.seek(0, 2)
+        size = self.file.tell()
+        tail = self.read_at(max(size - 1024, 0), 1024)
+        match = list(re.finditer(rb'startxref\s+(\d+)', tail))
+        if not match:
+            raise ValueError('no startxref')
+        offset = int(match[-1].group(1))
+        seen   = set()
+        # newer sections come first, the entries found first win
+        while offset is not None and offset not in seen:
+            seen.add(offset)
+            head = self.read_at(offset, 4)
+            if head == b'xref':
+                offset = self.read_table(offset)
+            else:
+                offset = self.read_stream(offset)
+
+    def read_table(self, offset):
+        """ read a classic xref section and its trailer,
+        return the offset of the previous section.
+        """
+        data = self.read_at(offset, self.chunk)
+        while b'trailer' not in data or b'>>' not in data[data.index(b'trailer'):]:
+            more = self.file.read(self.chunk)
+            if not more:
+                raise ValueError('no trailer')
+            data += more
+        table, trailer = data.split(b'trailer', 1)
+        lines = table.split()[1:]           # skip 'xref'
+        i = 0
+        while i + 1 < len(lines):
+            first, count = int(lines[i]), int(lines[i+1])
+            i += 2
+            for n in range(count):
+                pos, gen, kind = lines[i], lines[i+1], lines[i+2]
+                i += 3
+                if kind == b'n':
+                    self.offsets.setdefault(first + n, int(pos))
+        trailer = trailer.split(b'startxref')[0]
+        self.add_trailer(trailer)
+        return find_int(trailer, b'Prev')
+
+    def add_trailer(self, trailer):
+        if not self.trailer:
+            self.trailer = trailer
+        elif find_ref(self.trailer, b'Info') is None and find_ref(trailer, b'Info'):
+            self.trailer += trailer
+
+    def read_stream(self, offset):
+        """ read an xref stream, return the offset of the previous section
+        """
+        objdict, data = self.read_object_at(offset)
+        widths = [int(x) for x in re.search(rb'/W\s*\[([^\]]*)\]', objdict).group(1).split()]
+        index  = re.search(rb'/Index\s*\[([^\]]*)\]', objdict)
+        if index:
+            numbers = [int(x) for x in index.group(1).split()]
+        else:
+            numbers = [0, find_int(objdict, b'Size')]
+        step = sum(widths)
+        pos  = 0
+        for first, count in zip(numbers[0::2], numbers[1::2]):
+            for n in range(first, first + count):
+                fields, p = [], pos
+                for w in widths:
+                    fields.append(int.from_bytes(data[p:p+w], 'big') if w else None)
+                    p += w
+                pos += step
+                kind = 1 if fields[0] is None else fields[0]
+                if kind == 1:
+                    self.offsets.setdefault(n, fields[1])
+                elif kind == 2 and n not in self.offsets:
+                    self.packed.setdefault(n, (fields[1], fields[2]))
+        self.add_trailer(objdict)
+        return find_int(objdict, b'Prev')
+
+    def read_object_at(self, offset):
+        """ return the dictionary bytes and the decoded stream
+        data, if any, of the object at the offset.
+        """
+        data = self.read_at(offset, self.chunk)
+        while b'endobj' not in data and b'stream' not in data:
+            more = self.file.read(self.chunk)
+            if not more:
+                break
+            data += more
+        body = data[data.index(b'obj') + 3:]
+        if b'stream' in body and (b'endobj' not in body or
+                                  body.index(b'stream') < body.index(b'endobj')):
+            objdict = body[:body.index(b'stream')]
+            start   = offset + data.index(b'obj') + 3 + body.index(b'stream') + 6
+            length  = find_int(objdict, b'Length')
+            if length is None:
+                ref = find_ref(objdict, b'Length')
+                length = int(self.object(ref).split()[0])
+            raw = self.read_at(start, length + 2)
+            # the keyword is followed by CRLF or LF
+            raw = raw[2:] if raw.startswith(b'\r\n') else raw[1:]
+            raw = raw[:length]
+            return objdict, self.decode(objdict, raw)
+        return body[:body.index(b'endobj')] if b'endobj' in body else body, None
+
+    def decode(self, objdict, raw):
+        if b'/FlateDecode' not in objdict:
+            return raw
+        data = zlib.decompress(raw)
+        predictor = find_int(objdict, b'Predictor') or 1
+        if predictor >= 10:
+            columns = (find_int(objdict, b'Columns') or 1) + 1
+            rows, prev = [], bytearray(columns - 1)
+            for i in range(0, len(data), columns):
+                kind, row = data[i], bytearray(data[i+1:i+columns])
+                if kind == 2:           # PNG Up
+                    for j in range(len(row)):
+                        row[j] = (row[j] + prev[j]) & 0xff
+                elif kind == 1:         # PNG Sub
+                    for j in range(1, len(row)):
+                        row[j] = (row[j] + row[j-1]) & 0xff
+                rows.append(bytes(row))
+                prev = row
+            data = b''.join(rows)
+        return data
+
+    def object(self, number):
+        """ return the body of an object, without the stream data
+        """
+        if number in self.offsets:
+            return self.read_object_at(self.offsets[number])[0]
+        if number in self.packed:
+            stream, index = self.packed[number]
+            if stream not in self.streams:
+                objdict, data = self.read_object_at(self.offsets[stream])
+                first  = find_int(objdict, b'First')
+                count  = find_int(objdict, b'N')
+                header = data[:first].split()
+                starts = [int(x) for x in header[1::2]][:count]
+                objs   = []
+                for i, start in enumerate(starts):
+                    end = starts[i+1] if i + 1 < len(starts) else len(data) - first
+                    objs.append(data[first+start:first+end])
+                self.streams[stream] = objs
+            return self.streams[stream][index]
+        raise KeyError(number)
+
+    def value(self, data, name, find):
+        """ the value of a key of the dictionary, following one
+        level of indirect reference.
+        """
+        ref = find_ref(data, name)
+        if ref is not None:
+            # the object is the bare value, give it a key to find
+            obj = self.object(ref)
+            return find(b'/V ' + obj, b'V')
+        return find(data, name)
+
+def pdf_info(path):
+    """ return (page count, title) of a PDF file, None for unknown
+    """
+    pages = title = None
+    try:
+        reader = PDFReader(path)
+        try:
+            root  = reader.object(find_ref(reader.trailer, b'Root'))
+            tree  = reader.object(find_ref(root, b'Pages'))
+            pages = find_int(tree, b'Count')
+            info  = find_ref(reader.trailer, b'Info')
+            if info is not None:
+                title = reader.value(reader.object(info), b'Title', find_text)
+        finally:
+            reader.close()
+    except Exception:
+        # a broken file may fail the reader anywhere
+        pages = scan_pages(path)
+    return pages, title
+
+def scan_pages(path):
+    """ find the page count by searching the page tree nodes,
+    the root node has the largest count.
+    """
+    try:
+        data = open(path, 'rb').read()
+    except OSError:
+        return None
+    counts = [int(m.group(1)) for m in
+                re.finditer(rb'/Type\s*/Pages\b[^>]*?/Count\s+(\d+)', data)]
+    counts += [int(m.group(1)) for m in
+                re.finditer(rb'/Count\s+(\d+)[^>]*?/Type\s*/Pages\b', data)]
+    return max(counts) if counts else None
+
+def info_of(path):
+    """ worker of the process pool, a file that cannot be read
+    is listed with unknown pages and title, one bad file must not
+    stop the scan.
+    """
+    try:
+        stat = os.stat(path)
+        return path, stat.st_size, stat.st_mtime, pdf_info(path)
+    except Exception:
+        return path, None, None, (None, None)
+
+class Scanner:
+    """ Scan a directory for PDF books in a process pool, the
+    page count and the title of each book are cached with the
+    size and the modified time of the file, so only the new
+    and changed files are read again.
+    """
+    cache_file = '.scan_cache'
+
+    def __init__(self, config):
+        self.config = config
+        self.cache_path = os.path.join(config.base_dir, self.cache_file)
+
+    def find(self, dir):
+        for top, dirs, files in os.walk(dir):
+            for name in files:
+                if name.lower().endswith('.pdf'):
+                    yield os.path.realpath(os.path.join(top, name))
+
+    def scan(self, dir):
+        """ return a sorted list of (path, pages, title) of the books
+        """
+        rec   = Recorder(self.cache_path)
+        cache = rec.opendb()
+        paths = list(self.find(dir))
+        stale = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # a broken link, or removed since it was found
+                stale.append(path)
+                continue
+            entry = cache.get(path)
+            if entry is None or entry[:2] != (stat.st_size, stat.st_mtime):
+                stale.append(path)
+        # do not hold the cache while the workers run
+        rec.closedb()
+        results = []
+        if stale:
+            with ProcessPoolExecutor() as pool:
+                results = list(pool.map(info_of, stale, chunksize=8))
+
+        def update(cache):
+            for path, size, mtime, (pages, title) in results:
+                cache[path] = (size, mtime, pages, title)
+            prefix = os.path.join(os.path.realpath(dir), '')
+            found  = set(paths)
+            for path in [p for p in cache.keys(min=prefix) if p.startswith(prefix)]:
+                if path not in found:
+                    del cache[path]
+            return [(path,) + cache[path][2:] for path in sorted(found)]
+        books = rec.transact(update)
+        rec.closedb()
+        print('%s books, %s read' % (len(books), len(stale)), file=sys.stderr)
+        return books
@@ -0,0 +1,151 @@
+"""
+Versions of the record formats, and the migrations between them.
+
+Each record carries the version of its format in the 'schema'
+attribute, none for the records saved before the versioning.
+A record is upgraded in memory when it is loaded (see Record),
+so the code always sees the current format, and is stored in
+the current format when saved. The Migrator rewrites the stored
+records in bounded batches, so a store can be upgraded without
+one long transaction, the progress is kept in the database and
+an interrupted migration resumes where it stopped.
+"""
+
+import sys
+
+def v1_log(ent):
+    """ times and pages as integers
+    """
+    for name in ('start_time', 'end_time', 'start_page', 'end_page'):
+        value = getattr(ent, name, None)
+        if value is not None:
+            setattr(ent, name, int(value))
+    ent.complete = bool(getattr(ent, 'complete', False))
+
+def v2_log(ent):
+    """ the seconds of pause within a log, see Logger.compact
+    """
+    if getattr(ent, 'paused', None) is None:
+        ent.paused = 0
+
+def v1_note(ent):
+    """ chapter as integer, subject always present
+    """
+    ent.chapter = int(ent.chapter)
+    if not hasattr(ent, 'subject'):
+        ent.subject = ''
+
+def v1_errata(ent):
+    """ page as text
+    """
+    ent.page = str(ent.page)
+
+# migrations[kind][n] upgrades a record from version n to n + 1
+migrations = {
+    'log':    [v1_log, v2_log],
+    'note':   [v1_note],
+    'errata': [v1_errata],
+}
+
+def kind_of(ent):
+    fields = ent.__dict__
+    if 'start_time' in fields:
+        return 'log'
+    if 'chapter' in fields:
+        return 'note'
+    if 'page' in fields:
+        return 'errata'
+    return None
+
+def current(kind):
+    return len(migrations[kind])
+
+def upgrade(ent):
+    """ bring the record to the current version, return True
+    if anything was done.
+    """
+    kind = kind_of(ent)
+    if kind is None:
+        return False
+    version = ent.__dict__.get('schema', 0)
+    steps   = migrations[kind][version:]
+    for step in steps:
+        step(ent)
+    ent.schema = current(kind)
+    return bool(steps)
+
+class Migrator:
+    """ Rewrite the records of a container that are not in the
+    current version. The 'schema' container of the database
+    records the version of each container, and the last key
+    done while a migration is in progress.
+    """
+    schemaName = 'schema'
+    batch_size = 1000
+
+    def __init__(self, recorder, kind):
+        self.recorder = recorder
+        self.kind     = kind
+        self.name     = recorder.contName
+        self.progress = self.name + '.progress'
+
+    def status(self):
+        """ return (stored version, current version, progress key)
+        """
+        state = self.recorder.opendb(self.schemaName)
+        return (state.get(self.name, 0), current(self.kind), state.get(self.progress))
+
+    def done(self):
+        version, latest, progress = self.status()
+        return version >= latest
+
+    def step(self):
+        """ migrate one batch, return False when all are done
+        """
+        rec = self.recorder
+
+        def migrate(cont):
+            state = rec.opendb(self.schemaName)
+            start = state.get(self.progress)
+            range = {} if start is None else dict(min=start, excludemin=True)
+            count = 0
+            last  = None
+            for key, ent in cont.items(**range):
+                if count >= self.batch_size:
+                    break
+                # loading has upgraded it, storing it is what is left
+                if getattr(ent, '_upgraded', False):
+                    rec.put(cont, key, ent)
+                last   = key
+                count += 1
+            if last is None:
+                state[self.name] = current(self.kind)
+                if self.progress in state:
+                    del state[self.progress]
+                return False
+            state[self.progress] = last
+            return True
+
+        # make sure the container exists before the transaction
+        rec.opendb(self.schemaName)
+        # the content is the same, the consumers of the journal skip it
+        with rec.unjournaled():
+            return rec.transact(migrate)
+
+    def run(self, batches=None):
+        """ migrate at most the given number of batches, all if None
+        """
+        if self.done():
+            print('%s: up to date' % self.recorder.db_path)
+            return
+        count = 0
+        while batches is None or count < batches:
+            if not self.step():
+                print('%s: migrated to version %s' % (self.recorder.db_path, current(self.kind)))
+                return
+            count += 1
+            # keep the memory bounded
+            self.recorder.conn.cacheGC()
+        version, latest, progress = self.status()
+        print('%s: in progress, up to key %s' % (self.recorder.db_path, progress),
+                file=sys.stderr)
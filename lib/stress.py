@@ -0,0 +1,46 @@
+#!/usr/bin/python3
+"""
+Stress test of the write path: run many writer processes against
+one log database at the same time, each one opens the database,
+saves one record and closes it, the way the viewer and the command
+line do. Finally check that no record is lost.
+
+Usage: stress.py [writers] [records per writer] [db path]
+"""
+
+import sys, os, time, tempfile
+from multiprocessing import Process
+from logger import Logger
+
+def writer(db_path, number, count):
+    logger = Logger(db_path)
+    for i in range(count):
+        start = 1000000000 + number * count + i
+        ent = logger.make_log('stress', start, start + 60, i, i + 1, True)
+        logger.save(str(ent.start_time), ent)
+        logger.closedb()
+
+def stress(writers=8, count=25, db_path=None):
+    """ return True if every record written is found
+    """
+    if db_path is None:
+        db_path = os.path.join(tempfile.mkdtemp(), '.log')
+    start = time.time()
+    procs = [Process(target=writer, args=(db_path, n, count)) for n in range(writers)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    elapsed = time.time() - start
+
+    logger = Logger(db_path)
+    found  = len(logger.opendb())
+    logger.closedb()
+    failed = [p.pid for p in procs if p.exitcode != 0]
+    print('%s writers x %s records: %s found, %s writers failed, %.2fs' % (
+            writers, count, found, len(failed), elapsed))
+    return found == writers * count and not failed
+
+if __name__ == '__main__':
+    args = [int(x) for x in sys.argv[1:3]] + sys.argv[3:4]
+    exit(0 if stress(*args) else 1)
@@ -0,0 +1,265 @@
+"""
+The session supervisor, a background process which starts the
+viewer processes, keeps track of them, and logs the sessions.
+
+The commands talk to it through a unix socket in the base
+directory, one JSON request and one JSON reply per connection:
+
+    {"op": "read", "page": 0, "log": true}  start a session
+    {"op": "list"}                          the running sessions
+    {"op": "stop", "id": 1}                 terminate a session
+
+It is started by the first 'read', and quits when no session
+has run for 'idle_exit' seconds.
+"""
+
+import os, sys, json, time, fcntl, socket, asyncio, traceback, contextlib
+from concurrent.futures import ThreadPoolExecutor
+from logger import Logger
+from viewer import Viewer, viewer_command
+
+class Session:
+    """ A viewer process and the times and pages of the reading
+    """
+    def __init__(self, id, config, process, start_page, take_log):
+        self.id         = id
+        self.config     = config            # the settings at the start
+        self.process    = process
+        self.start_page = start_page        # physical
+        self.take_log   = take_log
+        self.start_time = int(time.time())
+        self.started    = time.time()       # to tell a stale viewer log
+        self.end_time   = None
+        self.end_page   = None
+
+    def info(self):
+        return {'id': self.id, 'pid': self.process.pid, 'start_time': self.start_time,
+                'start_page': self.config.page_map.number(self.start_page)}
+
+class Supervisor:
+    """ Run the viewers as subprocesses of the event loop, a
+    session is waited for by a task, so any number of them run
+    at the same time without blocking the requests.
+
+    The settings are loaded again for each read request, so a
+    change of the book or of the labels is seen by the running
+    supervisor, a session keeps the settings it started with.
+
+    The finished sessions are logged through one logger per log
+    database, every 'flush_delay' seconds the ones which finished
+    since the last flush are saved in one transaction per database,
+    the database is closed between the flushes for the other
+    processes. The database work is done in one thread.
+
+    The sessions are marked and the end page is read through
+    the 'viewer' class, a subclass of Viewer can be set for a
+    program which records the last page in another way.
+    """
+    viewer      = Viewer
+    socket_file = '.supervisor'
+    lock_file   = '.supervisor.lock'
+    log_file    = '.supervisor.log'
+    flush_delay = 2
+    idle_exit   = 60
+
+    def __init__(self, config):
+        self.config   = config
+        self.loggers  = {}
+        self.db       = ThreadPoolExecutor(1)
+        self.sessions = {}
+        self.pending  = []
+        self.next_id  = 1
+
+    async def serve(self):
+        loop   = asyncio.get_running_loop()
+        path   = socket_path(self.config)
+        server = await asyncio.start_unix_server(self.handle, path=path)
+        self.idle = loop.time()
+        try:
+            while self.sessions or self.pending or loop.time() - self.idle < self.idle_exit:
+                await asyncio.sleep(self.flush_delay)
+                await self.flush()
+        finally:
+            server.close()
+            await server.wait_closed()
+            if os.path.exists(path):
+                os.unlink(path)
+            self.db.shutdown()
+
+    async def handle(self, reader, writer):
+        try:
+            request = json.loads(await reader.readline())
+            reply   = await self.dispatch(request)
+        except (ValueError, KeyError, TypeError, OSError) as e:
+            reply   = {'error': str(e)}
+        writer.write(json.dumps(reply).encode() + b'\n')
+        await writer.drain()
+        writer.close()
+
+    async def dispatch(self, request):
+        op = request['op']
+        if op == 'read':
+            await asyncio.get_running_loop().run_in_executor(self.db, self.reload)
+            session = await self.start(int(request.get('page') or 0), request.get('log', True))
+            return {'session': session.info()}
+        if op == 'list':
+            return {'sessions': [x.info() for x in self.sessions.values()]}
+        if op == 'stop':
+            session = self.sessions.get(request['id'])
+            if session is None:
+                raise ValueError('no session %s' % request['id'])
+            session.process.terminate()
+            return {'session': session.info()}
+        raise ValueError('unknown request: %s' % op)
+
+    def reload(self):
+        """ read the settings again, the class of the config is
+        used, the config module imports this one.
+        """
+        self.config = type(self.config)(self.config.base_dir)
+
+    def logger(self, config):
+        path = config.log_path
+        if path not in self.loggers:
+            self.loggers[path] = Logger(path)
+        return self.loggers[path]
+
+    async def start(self, page, take_log):
+        """ start a viewer at the page, or where the reading stopped
+        """
+        loop   = asyncio.get_running_loop()
+        config = self.config
+        if not page:
+            page = await loop.run_in_executor(self.db, self.start_page, config)
+        physical = config.page_map.page(page)
+        process  = await asyncio.create_subprocess_exec(
+                        *viewer_command(config, physical), stdin=asyncio.subprocess.DEVNULL)
+        session  = Session(self.next_id, config, process, physical, take_log)
+        self.next_id += 1
+        self.sessions[session.id] = session
+        session.marker = self.viewer.mark_session(config.base_dir, process.pid)
+        session.task   = asyncio.create_task(self.wait(session))
+        return session
+
+    def start_page(self, config):
+        logger = self.logger(config)
+        page   = logger.cal_start_page()
+        logger.closedb()
+        return page
+
+    async def wait(self, session):
+        """ note the end of the session when the viewer quits
+        """
+        loop = asyncio.get_running_loop()
+        await session.process.wait()
+        session.end_time = int(time.time())
+        # the marker of a dead process may be removed by active_sessions
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(session.marker)
+        if session.take_log:
+            try:
+                session.end_page = await loop.run_in_executor(self.db, self.viewer.read_end_page,
+                                        session.config.book_path, session.config.page_map,
+                                        session.started)
+            except Exception:
+                # logged as a temporary log, to be completed by 'log'
+                traceback.print_exc()
+            self.pending.append(session)
+        del self.sessions[session.id]
+        self.idle = loop.time()
+
+    async def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        failed = await asyncio.get_running_loop().run_in_executor(self.db, self.save, batch)
+        # tried again at the next flush
+        self.pending = failed + self.pending
+
+    def save(self, sessions):
+        """ log the finished sessions, in one transaction per database,
+        return the sessions which could not be saved.
+        """
+        failed  = []
+        batches = {}
+        for x in sessions:
+            batches.setdefault(x.config.log_path, []).append(x)
+        for batch in batches.values():
+            logger = self.logger(batch[0].config)
+            logs   = [logger.make_log(
+                        book_name=x.config.book_name,
+                        start_time=x.start_time,
+                        end_time=x.end_time,
+                        start_page=x.config.page_map.number(x.start_page),
+                        end_page=x.end_page,
+                        complete=bool(x.end_page)) for x in batch]
+
+            def put(cont):
+                for ent in logs:
+                    # sessions started in the same second, the key is the start
+                    while str(ent.start_time) in cont:
+                        ent.start_time += 1
+                    ent.end_time = max(ent.end_time, ent.start_time)
+                    logger.put(cont, str(ent.start_time), ent)
+            try:
+                logger.transact(put)
+            except Exception:
+                traceback.print_exc()
+                failed += batch
+            finally:
+                logger.closedb()
+        return failed
+
+def socket_path(config):
+    return os.path.join(config.base_dir, Supervisor.socket_file)
+
+def run(config):
+    """ run the supervisor, unless one is running already
+    """
+    lock = open(os.path.join(config.base_dir, Supervisor.lock_file), 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return
+    asyncio.run(Supervisor(config).serve())
+
+def spawn(config):
+    """ start the supervisor as a detached process
+    """
+    if os.fork():
+        return
+    os.setsid()
+    try:
+        log = open(os.path.join(config.base_dir, Supervisor.log_file), 'a')
+        os.dup2(os.open(os.devnull, os.O_RDONLY), 0)
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        run(config)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(0)
+
+def request(config, message, start=False):
+    """ send a request to the supervisor, return the reply, None
+    if it is not running, it is started if start is True.
+    """
+    path = socket_path(config)
+    for attempt in range(50):
+        try:
+            sock = socket.socket(socket.AF_UNIX)
+            sock.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            sock.close()
+            if not start:
+                return None
+            if attempt % 10 == 0:
+                spawn(config)
+            time.sleep(0.1)
+            continue
+        with sock:
+            sock.sendall(json.dumps(message).encode() + b'\n')
+            return json.loads(sock.makefile().readline())
+    raise OSError('the supervisor does not answer, see %s' % Supervisor.log_file)
@@ -45,3 +45,44 @@ def strtosecond(timestr):
 
     timestr = ' '.join(arr)
     return isostrtosecond(timestr)
+
+# 'HH:MM' of each minute of a day
+day_minutes = ['%02d:%02d' % divmod(x, 60) for x in range(1440)]
+
+class DayClock:
+    """
+    format seconds as '%Y-%m-%d %H:%M', or as their day, in bulk,
+    localtime and strftime are called once per calendar day, the
+    time of the day is looked up by the minutes from the start of
+    the day. Days that are not 24 hours long (DST change) fall back
+    to strftime.
+    """
+    def __init__(self):
+        self.start  = self.end = 0
+        self.date   = None
+        self.prefix = None
+
+    def __call__(self, second):
+        if not self.start <= second < self.end:
+            self.load(second)
+        if self.date is None:
+            return strftime('%Y-%m-%d %H:%M', localtime(second))
+        return self.prefix + day_minutes[(second - self.start) // 60]
+
+    def day(self, second):
+        """ the '%Y-%m-%d' of the second
+        """
+        if not self.start <= second < self.end:
+            self.load(second)
+        return self.date or strftime('%Y-%m-%d', localtime(second))
+
+    def load(self, second):
+        t = localtime(second)
+        day = (t.tm_year, t.tm_mon, t.tm_mday)
+        self.start = int(mktime(day + (0, 0, 0, 0, 0, -1)))
+        self.end   = int(mktime((t.tm_year, t.tm_mon, t.tm_mday + 1, 0, 0, 0, 0, 0, -1)))
+        if self.end - self.start == 86400:
+            self.date   = strftime('%Y-%m-%d', t)
+            self.prefix = self.date + ' '
+        else:
+            self.date   = None
@@ -1,73 +1,84 @@
-import time
 import os
+import sys
+import shlex
+
+def viewer_command(config, page):
+    """ the command to open the book at the physical page, the
+    setting viewer_command has {page} and {book} in its arguments.
+    """
+    return [x.format(page=page, book=config.book_path)
+                for x in shlex.split(config.viewer_command)]
 
 class Viewer:
-    """ class for openning the book, and go to a specified page,
-    waiting for it to return, and retain the time info of the
-    start and the end as well as the last page.
+    """ The viewing sessions and the last page of the viewer, the
+    viewer processes are run by the supervisor (see supervisor.py).
 
-    To use different program to view the book, extend this class,
-    and redefine the 'run' and 'get_end_page' methods.
+    The program is given by the viewer_command setting. To use a
+    program which records the last page in another way, extend
+    this class, redefine the 'read_end_page' method, and set the
+    'viewer' attribute of the Supervisor to the new class.
     """
     viewer_log = os.path.join(os.getenv('HOME'), '.pv')
 
-    def __init__(self, logger, config, start_page=0, take_log=True):
-        if start_page:
-            self.start_page = start_page + config.page_num_diff
-        else:
-            self.start_page = logger.cal_start_page() + config.page_num_diff
-        self.take_log = take_log
-        self.logger = logger
-        self.book = config.book_path
-        self.config = config
-        self.__view()
-        
-    def __view(self):
-        self.run()
-        self.__log()
+    @classmethod
+    def session_dir(cls, base_dir):
+        return os.path.join(base_dir, '.viewing')
 
-    def __log(self):
-        """ log the start time, end time, start page, and end page
+    @classmethod
+    def mark_session(cls, base_dir, pid=None):
+        """ create a marker file named by the pid for the
+        viewing session, the current process by default,
+        return the path of it.
         """
-        if not self.take_log:
-            return
-        complete = bool(self.end_page)
-        ent = self.logger.make_log(
-                    book_name=self.config.book_name,
-                    start_time=self.start_time,
-                    end_time=self.end_time,
-                    start_page=self.start_page - self.config.page_num_diff,
-                    end_page=self.end_page,
-                    complete=complete)
-        self.logger.save(str(ent.start_time), ent)
+        dir = cls.session_dir(base_dir)
+        os.makedirs(dir, exist_ok=True)
+        path = os.path.join(dir, str(pid or os.getpid()))
+        open(path, 'w').close()
+        return path
 
-    def run(self):
-        """ open the book with the specified program,
-        wait for it to end
+    @classmethod
+    def active_sessions(cls, base_dir):
+        """ return pids of the viewing sessions still running,
+        markers left by dead processes are removed.
         """
-        cmd = 'pv -p %s %s' % (self.start_page, self.book)
-        self.start_time = int(time.time())
-        os.system(cmd)
-        self.end_time = int(time.time())
-        self.end_page = self.get_end_page()
+        dir = cls.session_dir(base_dir)
+        if not os.path.isdir(dir):
+            return []
+        pids = []
+        for name in os.listdir(dir):
+            pid = int(name)
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                os.unlink(os.path.join(dir, name))
+                continue
+            except PermissionError:
+                pass
+            pids.append(pid)
+        return pids
 
-    def get_end_page(self):
-        """ get the last page number which was recorded
-        before the viewer program quit.
+    @classmethod
+    def read_end_page(cls, book, page_map, since=None):
+        """ the page number of the book in the viewer log, None
+        if the log was not written after the time since, e.g. the
+        viewer was killed, what it holds is of an earlier session.
         """
-        viewer_log = self.viewer_log
+        viewer_log = cls.viewer_log
         if not os.path.exists(viewer_log):
             print('%s not exists, check the viewer program' % viewer_log)
             return None
+        if since is not None and os.path.getmtime(viewer_log) < since:
+            print('%s not written by the session, complete the log manually' % viewer_log)
+            return None
 
-        file = os.path.realpath(self.book)
+        file = os.path.realpath(book)
         for line in open(viewer_log):
             arr  = line.split(' ')
             page = arr[-1]
             path = ' '.join(arr[:-1])
             if path == file:
-                page = int(page) - self.config.page_num_diff + 1
-                return page
+                # the viewer counts the pages from 0
+                return page_map.number(int(page) + 1)
 
         print('Failed to determine the end page')
         print(str(sys.exc_info()[1]) + '\nYou need to complete it manually')
@@ -0,0 +1,296 @@
+import io, os, time, pickle, bisect
+import ZODB
+from ZODB.FileStorage import FileStorage
+from ZODB.FileStorage.FileStorage import FileIterator
+from BTrees.OOBTree import OOBTree, OOBucket
+from logger import LogEntry, last_complete
+
+class Ref:
+    """ Stands for a reference to another persistent object
+    in the states read from the storage file.
+    """
+    def __init__(self, ref):
+        self.ref = ref
+
+class StateReader(pickle.Unpickler):
+    """ Load the state of an object from a data record,
+    references to other objects are not followed.
+    """
+    def persistent_load(self, ref):
+        return Ref(ref)
+
+def ref_oid(ref):
+    """ the oid of a reference read by StateReader
+    """
+    ref = ref.ref
+    if isinstance(ref, tuple):
+        return ref[0]
+    return ref if isinstance(ref, bytes) else None
+
+def read_state(data):
+    """ return (items, children) of a data record: the key/value
+    pairs of a bucket or of a tree held in one bucket, the oids of
+    the children of a tree node, None for what is not there.
+    """
+    reader = StateReader(io.BytesIO(data))
+    klass  = reader.load()
+    state  = reader.load()
+    if not isinstance(klass, type):
+        return None, None
+    if issubclass(klass, OOBucket):
+        return state[0], None
+    if not issubclass(klass, OOBTree):
+        return None, None
+    if state is None:
+        return (), set()
+    if len(state) == 1:
+        # a small tree keeps its only bucket in its own state
+        return state[0][0][0], set()
+    return None, {ref_oid(x) for x in state[0][0::2]}
+
+def bucket_of(tree, key):
+    """ the oid of the bucket where the key is, or would be
+    """
+    node = tree
+    while True:
+        state = node.__getstate__()
+        if state is None or len(state) == 1:
+            return node._p_oid
+        refs  = state[0]
+        child = refs[2 * bisect.bisect_right(refs[1::2], key)]
+        if not isinstance(child, OOBTree):
+            return child._p_oid
+        node  = child
+
+def storage_position(storage):
+    """ the offset in the file after the last transaction read by a
+    FileStorage or a FileIterator, there is no public way to get it,
+    this is the one place the watcher relies on their internals.
+    """
+    return storage._pos
+
+class TodayWatcher:
+    """ Show today's statistics, and update them whenever a
+    transaction is appended to the log database.
+
+    The FileStorage is locked by the writer, and a read only
+    storage does not see the transactions appended by other
+    processes, so the watcher reads the new transactions from
+    the file directly, starting from the position where the
+    last read stopped. Only the log entries of today found in
+    the new object states are looked at, the database is never
+    scanned again after the first range lookup.
+
+    The oids of the tree nodes and of the buckets holding the
+    logs of today are kept. A bucket is rewritten as a whole, so
+    the keys of today in its new state replace the ones in its
+    previous state, a key gone from it has been deleted, unless
+    it moved to another bucket in the same transaction. A bucket
+    left out of the new state of its parent node has been removed
+    with its keys. Packing replaces the file, the watcher starts
+    over with the new one then.
+    """
+    interval = 1
+
+    def __init__(self, logger, config, show):
+        self.path   = logger.db_path
+        self.logger = logger
+        self.config = config
+        self.show   = show          # function(start_page, page_count, spent_time)
+        self.reset()
+
+    def reset(self):
+        """ forget the state, for today
+        """
+        self.first    = int(time.mktime(time.strptime(time.strftime('%Y-%m-%d'), '%Y-%m-%d')))
+        self.last     = self.first + 86400 - 1
+        self.logs     = {}          # key -> log of today
+        self.owned    = {}          # bucket oid -> keys of today in it
+        self.children = {}          # tree node oid -> oids of the children
+        self.previous = None        # the last complete log before today
+        self.prev_key = ''          # its key
+        self.prev_oid = None        # the bucket holding it
+        self.stale    = False       # the previous one changed
+
+    def load(self):
+        """ read today's entries, the tree nodes above them and the
+        end of the committed data
+        """
+        self.reset()
+        self.inode = os.stat(self.path).st_ino
+        fs = FileStorage(self.path, read_only=True)
+        db = ZODB.DB(fs)
+        try:
+            conn = db.open()
+            cont = getattr(conn.root, self.logger.contName)
+            self.pos  = storage_position(fs)
+            self.oid  = cont._p_oid
+            self.walk(cont)
+            key = last_complete(cont, self.first)
+            if key:
+                self.previous = cont[key]
+                self.prev_key = key
+                self.prev_oid = bucket_of(cont, key)
+            conn.close()
+        finally:
+            db.close()
+
+    def walk(self, node):
+        """ note the children of the tree node, and the keys of
+        today in the buckets which may hold them
+        """
+        state = node.__getstate__()
+        if state is None:
+            return
+        if len(state) == 1:
+            self.own(node._p_oid, state[0][0][0])
+            return
+        refs = state[0]
+        self.children[node._p_oid] = {x._p_oid for x in refs[0::2]}
+        for i in range(0, len(refs), 2):
+            child = refs[i]
+            if isinstance(child, OOBTree):
+                self.walk(child)
+                continue
+            low  = refs[i-1] if i else None
+            high = refs[i+1] if i + 1 < len(refs) else None
+            if (low is None or low <= str(self.last)) and (high is None or high > str(self.first)):
+                self.own(child._p_oid, child.__getstate__()[0])
+
+    def own(self, oid, items):
+        """ note the logs of today among the key/value pairs of a
+        bucket, return them.
+        """
+        logs = {}
+        for key, log in zip(items[0::2], items[1::2]):
+            # the undo log of the compaction holds logs too, under tuple keys
+            if isinstance(key, str) and isinstance(log, LogEntry) and self.today(key):
+                logs[key] = log
+        if logs:
+            self.owned[oid] = set(logs)
+        self.logs.update(logs)
+        return logs
+
+    def drop(self, oid):
+        """ forget a removed bucket or node, return the keys in it
+        """
+        if oid == self.prev_oid:
+            self.stale = True
+        keys = self.owned.pop(oid, set())
+        for child in self.children.pop(oid, ()):
+            keys |= self.drop(child)
+        return keys
+
+    def stats(self):
+        spent = pages = 0
+        for log in self.logs.values():
+            if log.complete:
+                spent += log.duration()
+                pages += log.end_page - log.start_page
+        return pages, spent
+
+    def today(self, key):
+        return str(self.first) <= key <= str(self.last)
+
+    def apply(self, records):
+        """ update today's entries from the data records of a transaction
+        """
+        states = {}
+        for record in records:
+            if record.data is not None:
+                states[record.oid] = read_state(record.data)
+        # the nodes of the log tree, new ones are children of known ones
+        nodes = [x for x in states if x == self.oid or x in self.children]
+        for oid in nodes:
+            children = states[oid][1] or ()
+            nodes += [x for x in children if x in states and x not in nodes]
+        listed = set()
+        for oid in nodes:
+            listed |= states[oid][1] or set()
+
+        gone = set()
+        for oid in nodes:
+            children = states[oid][1]
+            if children is None:
+                continue
+            for child in self.children.get(oid, set()) - listed:
+                gone |= self.drop(child)
+            self.children[oid] = children
+        new = {}
+        for oid, (items, children) in states.items():
+            gone |= self.owned.pop(oid, set())
+            if items:
+                new.update(self.own(oid, items))
+                self.check_previous(oid, items)
+        for key in gone - set(new):
+            self.logs.pop(key, None)
+
+    def check_previous(self, oid, items):
+        """ note if the last complete log before today is changed
+        or deleted, or a later one is added, in a new bucket state
+        """
+        prev  = self.previous
+        low   = self.prev_key
+        found = False
+        for key, log in zip(items[0::2], items[1::2]):
+            if not (isinstance(key, str) and isinstance(log, LogEntry)):
+                return
+            if oid == self.prev_oid and key == low:
+                found = log.complete and log.end_page == prev.end_page
+            elif low < key < str(self.first) and log.complete:
+                self.stale = True
+        if oid == self.prev_oid and not found:
+            self.stale = True
+
+    def poll(self):
+        """ read the transactions appended since the last poll,
+        return True if any of today's entries changed.
+        """
+        stat = os.stat(self.path)
+        if stat.st_ino != self.inode or stat.st_size < self.pos:
+            # packed, the file is a new one, read it again
+            self.load()
+            return True
+        if stat.st_size <= self.pos:
+            return False
+        before = self.figures()
+        iterator = FileIterator(self.path, pos=self.pos)
+        try:
+            for txn in iterator:
+                self.apply(txn)
+            self.pos = storage_position(iterator)
+        finally:
+            iterator.close()
+        if self.stale:
+            # seldom, a log before today is changed, look it up again
+            self.load()
+        return self.figures() != before
+
+    def figures(self):
+        """ (start_page, page_count, spent_time), the start page is
+        worked out from the last complete log, as 'today' does.
+        """
+        pages, spent = self.stats()
+        complete = [k for k, x in self.logs.items() if x.complete]
+        last = self.logs[max(complete)] if complete else self.previous
+        return (last.end_page if last else 1) - pages, pages, spent
+
+    def render(self):
+        self.show(*self.figures())
+
+    def watch(self):
+        self.load()
+        self.render()
+        try:
+            while True:
+                time.sleep(self.interval)
+                if time.time() > self.last:
+                    # a new day begins
+                    self.load()
+                elif not self.poll():
+                    continue
+                print()
+                print(time.strftime('%H:%M:%S'))
+                self.render()
+        except KeyboardInterrupt:
+            print()